@@ -24,13 +24,13 @@ data = data.reshape([-1, 7])
 geometry = data[:, 0:6]
 proj_data = data[:, -1]
 
-# Specify the volume geometry
+# Specify the volume geometry, float32 like EMrecon itself
 fov = np.array([800., 800., 300.])
 shape = np.array([100, 100, 50])
-space = odl.uniform_discr(-fov/2, fov/2, shape)
+space = odlemrecon.volume_space(fov, shape)
 
-# The range for list mode data is simply a list of real numbers, hence rn.
-ran = odl.rn(proj_data.size, dtype='float32')
+# The range for list mode data is simply a list of real numbers.
+ran = odlemrecon.listmode_space(proj_data.size)
 
 # SCANNERTYPE 1 means list mode projector, see EMrecon doc
 settings = {'SCANNERTYPE': 1}
@@ -39,10 +39,18 @@ settings = {'SCANNERTYPE': 1}
 op = odlemrecon.EMReconForwardProjectorList(space, ran, geometry,
                                             settings=settings)
 
+# Store the iterate every 10 iterations. Running the example again continues
+# from the latest checkpoint, unless the data or the geometry have changed.
+checkpointer = odlemrecon.Checkpointer(
+    'emrecon_gate_checkpoints', interval=10,
+    key={'data': filen, 'settings': settings, 'fov': fov.tolist(),
+         'shape': shape.tolist()})
+
 # Solve the problem using the MLEM method. Note that the regular MLEM method
 # does not apply to the case of list mode data, but that an adequate
 # approximation is given by ignoring the sensitivities (setting them to 1).
 x = op.domain.one()
-odl.solvers.mlem(op, x, proj_data, niter=100,
-                 callback=odl.solvers.CallbackShow(cmap='hot'),
-                 sensitivities=1.0)
+odlemrecon.checkpointed_mlem(op, x, proj_data, niter=100,
+                             checkpointer=checkpointer,
+                             callback=odl.solvers.CallbackShow(cmap='hot'),
+                             sensitivities=1.0)
@@ -0,0 +1,34 @@
+"""Example of whole-body PET reconstruction from several GATE bed positions.
+
+This example requires that the user has access to the .l files output from
+gate for each bed position, the file paths here are examples. The event
+coordinates are expected in the patient frame, so that each bed is
+reconstructed at its axial position.
+
+The beds are reconstructed concurrently, one process per bed, and blended
+into a single volume where they overlap.
+"""
+
+import odlemrecon
+import numpy as np
+import os
+
+# NOTE: These folders need to be updated to local paths.
+folder = '/media/windows-share/emrecon_gate_list_mode_chest'
+filen = 'PulmPET_Lesions_20160826_Phantom1_BedPos{}.l'
+
+# Field of view of a single bed, the beds overlap by 100 mm axially
+fov = np.array([800., 800., 300.])
+shape = np.array([100, 100, 50])
+bed_z = [-400., -200., 0., 200.]
+
+# List mode data, each file holds the n x 7 events of one bed
+beds = [{'z': z, 'data': os.path.join(folder, filen.format(i + 1))}
+        for i, z in enumerate(bed_z)]
+
+# SCANNERTYPE 1 means list mode projector, see EMrecon doc
+settings = {'SCANNERTYPE': 1}
+
+x = odlemrecon.multibed_reconstruction(beds, fov, shape, settings,
+                                       niter=3, subsets=20)
+x.show(cmap='hot')
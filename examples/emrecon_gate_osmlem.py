@@ -4,7 +4,8 @@ This example requires that the user has access to a .l file output from gate,
 the file paths here are examples.
 
 This example uses ordered subsets to speed up the iterates and is thus much
-faster than the comparable mlem method.
+faster than the comparable mlem method. The events of the next subset are
+staged while EMrecon processes the current one.
 """
 
 import odl
@@ -26,30 +27,23 @@ filen = 'PulmPET_Lesions_20160826_Phantom1_BedPos2.l'
 data = np.fromfile(os.path.join(folder, filen), dtype='float32')
 data = data.reshape([-1, 7])
 
-# Throw away extra data to make number of points evenly divisible
-data = data[:subsets * (data.shape[0] // subsets), :]
+# Split into subsets of equal size, each covering all LOR directions. The
+# events of each subset are sorted by LOR position for a faster projection.
+geometry, proj_data = odlemrecon.partition_events(data, subsets)
 
-geometry = data[:, 0:6]
-proj_data = data[:, -1]
-
-# reshape data into subsets
-geometry = geometry.reshape([subsets, -1, 6])
-proj_data = proj_data.reshape([subsets, -1])
-
-# Specify the volume geometry
+# Specify the volume geometry, float32 like EMrecon itself
 fov = np.array([800., 800., 300.])
 shape = np.array([100, 100, 50])
-space = odl.uniform_discr(-fov/2, fov/2, shape)
-
-# The range for list mode data is simply a list of real numbers, hence rn.
-ran = odl.rn(proj_data[0].size, dtype='float32')
+space = odlemrecon.volume_space(fov, shape)
 
 # SCANNERTYPE 1 means list mode projector, see EMrecon doc
 settings = {'SCANNERTYPE': 1}
 
-# Create projectors for each set of lines
+# Create projectors for each set of lines. The range for list mode data is
+# simply a list of real numbers.
 op = []
 for i in range(subsets):
+    ran = odlemrecon.listmode_space(proj_data[i].size)
     op += [odlemrecon.EMReconForwardProjectorList(space, ran, geometry[i],
                                                   settings=settings)]
 
@@ -58,6 +52,6 @@ for i in range(subsets):
 # does not apply to the case of list mode data, but that an adequate
 # approximation is given by ignoring the sensitivities (setting them to 1).
 x = space.one()
-odl.solvers.osmlem(op, x, proj_data, niter=3,
-                   callback=odl.solvers.CallbackShow(cmap='hot'),
-                   sensitivities=1.0 / subsets)
+odlemrecon.pipelined_osmlem(op, x, proj_data, niter=3,
+                            callback=odl.solvers.CallbackShow(cmap='hot'),
+                            sensitivities=1.0 / subsets)
@@ -0,0 +1,62 @@
+"""Example of TV regularized PET reconstruction of list mode data from GATE.
+
+This example requires that the user has access to a .l file output from gate,
+the file paths here are examples.
+
+The stochastic primal-dual hybrid gradient method uses one projector per
+subset of events. Each iteration applies a single subset projector or the
+gradient, so a pass over all subsets costs about as much as one iteration
+of the Douglas-Rachford example.
+"""
+
+import odl
+import odlemrecon
+import numpy as np
+import os
+
+# Select number of subsets
+subsets = 20
+
+# NOTE: These folders need to be updated to local paths.
+folder = '/media/windows-share/emrecon_gate_list_mode_chest'
+filen = 'PulmPET_Lesions_20160826_Phantom1_BedPos2.l'
+
+# Load data as a n x 7 array of [px_1, py_1, pz_1, px_2, py_2, pz_2, val]
+data = np.fromfile(os.path.join(folder, filen), dtype='float32')
+data = data.reshape([-1, 7])
+geometry, proj_data = odlemrecon.partition_events(data, subsets)
+
+# Specify the volume geometry, float32 like EMrecon itself
+fov = np.array([800., 800., 300.])
+shape = np.array([100, 100, 50])
+space = odlemrecon.volume_space(fov, shape)
+
+# SCANNERTYPE 1 means list mode projector, see EMrecon doc
+settings = {'SCANNERTYPE': 1}
+
+pet_ops = []
+for i in range(subsets):
+    ran = odlemrecon.listmode_space(proj_data[i].size)
+    pet_ops += [odlemrecon.EMReconForwardProjectorList(space, ran, geometry[i],
+                                                       settings=settings)]
+
+# Gradient for TV regularization, chosen in half of the iterations
+gradient = odl.Gradient(space)
+lin_ops = pet_ops + [gradient]
+prob = [0.5 / subsets] * subsets + [0.5]
+
+# Poisson data terms per subset and TV
+prox_cc_g = [odl.solvers.proximal_cconj_kl(op.range, g=op.range.element(d))
+             for op, d in zip(pet_ops, proj_data)]
+prox_cc_g += [odl.solvers.proximal_cconj_l1(gradient.range, lam=3e-1)]
+prox_f = odl.solvers.proximal_box_constraint(space, 0)
+
+tau, sigma = odlemrecon.spdhg_step_sizes(lin_ops, prob)
+
+x = space.zero()
+callback = (odl.solvers.CallbackShow(display_step=2 * subsets) &
+            odl.solvers.CallbackPrintIteration())
+odlemrecon.spdhg(x, prox_f, prox_cc_g, lin_ops, tau, sigma,
+                 niter=20 * 2 * subsets, prob=prob, callback=callback)
+
+x.show('spdhg result')
@@ -28,8 +28,8 @@ ran_shape = [192, 192, 175]
 settings = {'SCANNERTYPE': 3,
             'VERBOSE': 0}
 
-space = odl.uniform_discr(-fov/2, fov/2, shape)
-ran = odl.uniform_discr([0]*3, ran_shape, ran_shape)
+space = odlemrecon.volume_space(fov, shape)
+ran = odlemrecon.sinogram_space(ran_shape)
 
 op = odlemrecon.EMReconForwardProjector(space, ran, settings=settings)
 
@@ -23,8 +23,59 @@ from __future__ import absolute_import
 __all__ = ()
 
 
+from .scheduler import *
+__all__ += scheduler.__all__
+
+from .launcher import *
+__all__ += launcher.__all__
+
+from .em import *
+__all__ += em.__all__
+
 from .emreconoperators import *
 __all__ += emreconoperators.__all__
 
 from .util import *
 __all__ += util.__all__
+
+from .scratch import *
+__all__ += scratch.__all__
+
+from .systemmatrix import *
+__all__ += systemmatrix.__all__
+
+from .pipeline import *
+__all__ += pipeline.__all__
+
+from .distributed import *
+__all__ += distributed.__all__
+
+from .checkpoint import *
+__all__ += checkpoint.__all__
+
+from .multibed import *
+__all__ += multibed.__all__
+
+from .listmode import *
+__all__ += listmode.__all__
+
+from .dynamic import *
+__all__ += dynamic.__all__
+
+from .rebinning import *
+__all__ += rebinning.__all__
+
+from .convergence import *
+__all__ += convergence.__all__
+
+from .primaldual import *
+__all__ += primaldual.__all__
+
+from .roi import *
+__all__ += roi.__all__
+
+from .histogram import *
+__all__ += histogram.__all__
+
+from .streaming import *
+__all__ += streaming.__all__
@@ -0,0 +1,277 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checkpointing of long iterative reconstructions.
+
+A checkpoint directory contains the cached auxiliary arrays in ``aux`` and
+one ``step_<n>`` directory per stored iterate, where ``n`` counts completed
+updates (subsets for ordered-subsets methods). All arrays are float32
+``.npy`` files, which are memory-mapped when read back.
+
+The description of the run, e.g. its settings, shapes, number of subsets
+and data file, is stored in ``aux/key.json``. A directory is only resumed
+by a run with the same description, so that the iterate and cached arrays
+of another run are never used.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import odl
+
+from odlemrecon.em import osem
+
+__all__ = ('Checkpointer', 'CallbackCheckpoint', 'checkpointed_mlem')
+
+
+class Checkpointer(object):
+
+    """Periodic storage of iterates and cached auxiliary arrays."""
+
+    def __init__(self, directory, interval=10, keep=2, key=None):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        directory : `str`
+            Where the checkpoints are stored, created if needed. Use the same
+            directory to resume.
+        interval : positive `int`, optional
+            Store the iterate every ``interval`` updates.
+        keep : positive `int`, optional
+            Number of most recent checkpoints kept on disk.
+        key : `dict`, optional
+            Description of the run, see `check`.
+        """
+        self.directory = directory
+        self.interval = int(interval)
+        self.keep = int(keep)
+        for path in (directory, os.path.join(directory, 'aux')):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        if key is not None:
+            self.check(key)
+
+    def check(self, key):
+        """Bind the directory to the run described by ``key``.
+
+        Entries that are not stored yet are added, the others must be
+        equal to the stored ones. The solvers add the number of subsets and
+        the shapes of the iterate and the data themselves.
+
+        Parameters
+        ----------
+        key : `dict`
+            JSON-serializable description of the run, e.g. settings, data
+            file and number of events.
+
+        Raises
+        ------
+        ValueError
+            If an entry differs from the one stored by an earlier run.
+        """
+        # Compare in the stored form, e.g. tuples as lists
+        key = json.loads(json.dumps(key))
+        path = os.path.join(self.directory, 'aux', 'key.json')
+        stored = {}
+        if os.path.exists(path):
+            with open(path) as key_file:
+                stored = json.load(key_file)
+        for name, value in key.items():
+            if name in stored and stored[name] != value:
+                raise ValueError('checkpoints in {!r} belong to another run, '
+                                 '`{}` is {!r}, expected {!r}; use a new '
+                                 'directory'.format(self.directory, name,
+                                                    stored[name], value))
+        if all(name in stored for name in key):
+            return
+
+        stored.update(key)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        suffix='.json')
+        with os.fdopen(fd, 'w') as key_file:
+            json.dump(stored, key_file, sort_keys=True)
+        os.rename(tmp_path, path)
+
+    def _steps(self):
+        """Return the steps of the complete checkpoints, in order."""
+        steps = []
+        for name in os.listdir(self.directory):
+            if name.startswith('step_'):
+                steps.append(int(name[len('step_'):]))
+        return sorted(steps)
+
+    def _step_dir(self, step):
+        return os.path.join(self.directory, 'step_{:09d}'.format(step))
+
+    @staticmethod
+    def _write(path, array):
+        """Write ``array`` as float32 ``.npy`` file."""
+        array = np.asarray(array, dtype='float32')
+        out = np.lib.format.open_memmap(path, mode='w+', dtype='float32',
+                                        shape=array.shape)
+        out[:] = array
+        out.flush()
+        del out
+
+    def cached(self, name, compute):
+        """Return the auxiliary array ``name``, computing it only once.
+
+        Parameters
+        ----------
+        name : `str`
+            Identifier of the array, e.g. ``'sensitivities'``.
+        compute : `callable`
+            Called without arguments if the array is not stored yet.
+
+        Returns
+        -------
+        array : `numpy.memmap`
+            The stored array, memory-mapped read-only.
+        """
+        path = os.path.join(self.directory, 'aux', name + '.npy')
+        if not os.path.exists(path):
+            # Write next to the target and rename, so it is never partial
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                            suffix='.npy')
+            os.close(fd)
+            self._write(tmp_path, compute())
+            os.rename(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
+    def save(self, step, x):
+        """Store the iterate ``x`` reached after ``step`` updates."""
+        tmpdir = tempfile.mkdtemp(dir=self.directory, prefix='tmp_')
+        try:
+            self._write(os.path.join(tmpdir, 'x.npy'), x)
+            with open(os.path.join(tmpdir, 'meta.json'), 'w') as meta_file:
+                json.dump({'step': step}, meta_file)
+            os.rename(tmpdir, self._step_dir(step))
+        except Exception:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+
+        for old_step in self._steps()[:-self.keep]:
+            shutil.rmtree(self._step_dir(old_step), ignore_errors=True)
+
+    def step(self, step, x):
+        """Store ``x`` if ``step`` is a multiple of the interval."""
+        if step % self.interval == 0:
+            self.save(step, x)
+
+    def finish(self, step, x):
+        """Store the final iterate unless `step` has already stored it."""
+        if step % self.interval != 0:
+            self.save(step, x)
+
+    def latest(self):
+        """Return the step of the latest checkpoint, or 0 if none exists."""
+        steps = self._steps()
+        return steps[-1] if steps else 0
+
+    def restore(self, x):
+        """Load the latest checkpoint into ``x``.
+
+        Returns
+        -------
+        step : `int`
+            Number of updates already done, 0 if there is no checkpoint, in
+            which case ``x`` is left unchanged.
+        """
+        step = self.latest()
+        if step:
+            stored = np.load(os.path.join(self._step_dir(step), 'x.npy'),
+                             mmap_mode='r')
+            if stored.shape != np.shape(x):
+                raise ValueError('checkpoint has shape {}, expected {}'
+                                 ''.format(stored.shape, np.shape(x)))
+            x[:] = stored
+        return step
+
+    def callback(self, start=0):
+        """Return a solver callback storing every ``interval``-th iterate.
+
+        Parameters
+        ----------
+        start : nonnegative `int`, optional
+            Number of updates done before the solver was started, as
+            returned by `restore`.
+        """
+        return CallbackCheckpoint(self, start)
+
+
+class CallbackCheckpoint(odl.solvers.Callback):
+
+    """Solver callback that stores iterates with a `Checkpointer`."""
+
+    def __init__(self, checkpointer, start=0):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        checkpointer : `Checkpointer`
+            Where to store the iterates.
+        start : nonnegative `int`, optional
+            Number of updates done before the first call.
+        """
+        self.checkpointer = checkpointer
+        self.count = start
+
+    def __call__(self, x):
+        self.count += 1
+        self.checkpointer.step(self.count, x)
+
+
+def checkpointed_mlem(op, x, data, niter, checkpointer, sensitivities=None,
+                      callback=None, monitor=None):
+    """MLEM that can be resumed from a `Checkpointer`.
+
+    Continues from the latest checkpoint if one exists and stores iterates
+    while running. Computed sensitivities are cached by the checkpointer.
+
+    Parameters
+    ----------
+    op : `Operator`
+        Forward operator.
+    x : ``op.domain`` element
+        Starting point, overwritten by the checkpoint if one exists.
+    data : ``op.range`` `element-like`
+        Measured data.
+    niter : positive `int`
+        Total number of iterations, including those already done.
+    checkpointer : `Checkpointer`
+        Where to store the iterates.
+    sensitivities : `float` or ``op.domain`` `element-like`, optional
+        Default: `sensitivity_image` of ``op``.
+    callback : `callable`, optional
+        Called with the current iterate after each iteration.
+    monitor : `ConvergenceMonitor`, optional
+        Stops the iteration at convergence.
+
+    Returns
+    -------
+    niter : `int`
+        Number of iterations done, including those before the checkpoint.
+    """
+    if sensitivities is not None and not np.isscalar(sensitivities):
+        # One subset, so that an image is taken as sensitivity
+        sensitivities = [sensitivities]
+    return osem([op], x, [data], niter, sensitivities=sensitivities,
+                callback=callback, monitor=monitor, checkpointer=checkpointer)
@@ -0,0 +1,322 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Batch reconstruction of the studies listed in a manifest.
+
+The manifest is a JSON file with a list of studies::
+
+    {"studies": [
+        {"name": "qa_phantom",
+         "mode": "sinogram",
+         "data": "prompts.s",
+         "fov": [590.625, 590.625, 158.625],
+         "shape": [175, 175, 47],
+         "range_shape": [192, 192, 175],
+         "settings": {"SCANNERTYPE": 3},
+         "algorithm": "mlem",
+         "niter": 10,
+         "output": "qa_phantom.raw"},
+        {"name": "gate_bed2",
+         "mode": "listmode",
+         "data": "PulmPET_Lesions_20160826_Phantom1_BedPos2.l",
+         "fov": [800, 800, 300],
+         "shape": [100, 100, 50],
+         "settings": {"SCANNERTYPE": 1},
+         "algorithm": "osmlem",
+         "subsets": 20,
+         "niter": 3,
+         "output": "gate_bed2.raw",
+         "checkpoint": "gate_bed2.ckpt",
+         "checkpoint_interval": 20,
+         "memory_budget": 2000000000}
+    ]}
+
+Studies are run on a pool of long-lived worker processes. Studies sharing a
+geometry are run by one worker, which keeps the operators, settings files
+and sensitivity images of its most recent geometries, so that these are
+only paid for once. Results are
+written as float32 volumes in Fortran order.
+
+Studies with a ``checkpoint`` directory store their iterate every
+``checkpoint_interval`` updates and continue from there when the batch is
+run again. A ``memory_budget`` in bytes makes list-mode studies partition
+and project their events in chunks, with the data memory-mapped, so that
+memory use does not grow with the number of events.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import hashlib
+import json
+import multiprocessing
+import sys
+import time
+import traceback
+
+import numpy as np
+
+from odlemrecon.checkpoint import Checkpointer
+from odlemrecon.em import osem, sensitivity_image
+from odlemrecon.emreconoperators import (EMReconForwardProjector,
+                                         EMReconForwardProjectorList)
+from odlemrecon.listmode import memmap_events, partition_events
+from odlemrecon.pipeline import pipelined_osmlem
+from odlemrecon.scheduler import share_cores
+from odlemrecon.util import (settings_from_domain, make_settings_file,
+                             volume_space, sinogram_space, listmode_space)
+
+__all__ = ()
+
+
+# Per-process caches of the workers, keyed by geometry, least recently used
+# first
+_CACHE_SIZE = 2
+_OPERATORS = collections.OrderedDict()
+_SENSITIVITIES = collections.OrderedDict()
+
+
+def _cached(cache, key, compute):
+    """Return ``cache[key]``, computing it if needed.
+
+    The least recently used entries beyond `_CACHE_SIZE` are dropped, which
+    releases their scratch files.
+    """
+    if key in cache:
+        cache[key] = cache.pop(key)
+    else:
+        cache[key] = compute()
+        while len(cache) > _CACHE_SIZE:
+            cache.popitem(last=False)
+    return cache[key]
+
+
+def _geometry_key(study):
+    """Return a key identifying the projection geometry of a study."""
+    description = [study.get('mode', 'sinogram'),
+                   sorted((str(k), str(v))
+                          for k, v in study.get('settings', {}).items()),
+                   list(study['fov']), list(study['shape']),
+                   list(study.get('range_shape', []))]
+    if study.get('mode') == 'listmode':
+        # List-mode operators carry the events themselves
+        description += [study['data'], study.get('subsets', 1),
+                        study.get('memory_budget')]
+    return hashlib.sha1(json.dumps(description).encode('utf-8')).hexdigest()
+
+
+def _load_study(study):
+    """Return the operator(s) and data of a study, reusing cached state."""
+    key = _geometry_key(study)
+    space = volume_space(study['fov'], study['shape'])
+    settings = dict(study.get('settings', {}))
+
+    if study.get('mode', 'sinogram') == 'sinogram':
+        ran_shape = study['range_shape']
+        data = np.fromfile(study['data'], dtype='float32')
+        data = data.reshape(ran_shape, order='F')
+
+        def sinogram_operator():
+            settings.update(settings_from_domain(space))
+            return EMReconForwardProjector(
+                space, sinogram_space(ran_shape),
+                settings_file_name=make_settings_file(settings))
+
+        return key, _cached(_OPERATORS, key, sinogram_operator), data
+
+    def listmode_operators():
+        # The values are part of the key, so they are cached as well
+        geometry, values = partition_events(
+            memmap_events(study['data']), study.get('subsets', 1),
+            memory_budget=study.get('memory_budget'))
+        ops = [EMReconForwardProjectorList(
+                   space, listmode_space(len(geom)), geom,
+                   settings=dict(settings),
+                   memory_budget=study.get('memory_budget'))
+               for geom in geometry]
+        return ops, values
+
+    ops, values = _cached(_OPERATORS, key, listmode_operators)
+    return key, ops, values
+
+
+def _sensitivity(key, op):
+    """Return the cached `sensitivity_image` of ``op``."""
+    return _cached(_SENSITIVITIES, key, lambda: sensitivity_image(op))
+
+
+def _reconstruct(study):
+    """Reconstruct one study and write the result to its output file."""
+    start = time.time()
+    key, op, data = _load_study(study)
+    setup_time = time.time() - start
+
+    algorithm = study.get('algorithm', 'mlem')
+    niter = study.get('niter', 10)
+    if 'checkpoint' in study:
+        # Resuming with more iterations or another budget is fine
+        checkpoint_key = dict(
+            (name, value) for name, value in study.items()
+            if name not in ('name', 'output', 'niter', 'checkpoint',
+                            'checkpoint_interval', 'memory_budget'))
+        checkpointer = Checkpointer(study['checkpoint'],
+                                    study.get('checkpoint_interval', 10),
+                                    key=checkpoint_key)
+    else:
+        checkpointer = None
+
+    if study.get('mode', 'sinogram') == 'sinogram':
+        if algorithm != 'mlem':
+            raise ValueError('algorithm {!r} not supported for sinograms'
+                             ''.format(algorithm))
+        op, data = [op], [data]
+        sens = study.get('sensitivities')
+        if sens is None and checkpointer is None:
+            # One subset, so that an image is taken as sensitivity
+            sens = [_sensitivity(key, op[0])]
+    elif algorithm == 'mlem':
+        if len(op) != 1:
+            raise ValueError('list-mode mlem needs `subsets` = 1')
+        sens = study.get('sensitivities', 1.0)
+    elif algorithm == 'osmlem':
+        sens = study.get('sensitivities', 1.0 / len(op))
+    else:
+        raise ValueError('unknown algorithm {!r}'.format(algorithm))
+
+    x = op[0].domain.one()
+    # Passes over the subsets done by earlier runs of the study
+    done = 0.0 if checkpointer is None else (checkpointer.latest() /
+                                             float(len(op)))
+    if algorithm == 'osmlem':
+        niter = pipelined_osmlem(op, x, data, niter=niter,
+                                 sensitivities=sens,
+                                 checkpointer=checkpointer)
+    else:
+        niter = osem(op, x, data, niter, sensitivities=sens,
+                     checkpointer=checkpointer)
+
+    if 'output' in study:
+        np.asarray(x, dtype='float32').T.tofile(study['output'])
+
+    size = sum(np.size(values) for values in data)
+    return max(niter - done, 0.0), size, setup_time, time.time() - start
+
+
+def _run_study(study):
+    """Pool task, never raises so that one bad study does not stop a batch."""
+    try:
+        niter, size, setup_time, total_time = _reconstruct(study)
+    except Exception:
+        return {'name': study.get('name'), 'error': traceback.format_exc()}
+    return {'name': study.get('name'),
+            'niter': niter,
+            'size': size,
+            'setup_time': setup_time,
+            'time': total_time}
+
+
+def _run_group(studies):
+    """Pool task running studies that share a geometry, in order."""
+    return [_run_study(study) for study in studies]
+
+
+def _group_studies(studies, nworkers):
+    """Return tasks of studies sharing a geometry, largest first.
+
+    A group is only split when there are fewer groups than workers, to keep
+    all workers busy.
+    """
+    groups = collections.OrderedDict()
+    for study in studies:
+        groups.setdefault(_geometry_key(study), []).append(study)
+
+    tasks = []
+    for group in groups.values():
+        nparts = max(1, min(len(group), nworkers // len(groups)))
+        tasks += [group[i::nparts] for i in range(nparts)]
+    return sorted(tasks, key=len, reverse=True)
+
+
+def run_manifest(studies, nworkers=None):
+    """Reconstruct ``studies`` on a pool of worker processes.
+
+    Studies sharing a geometry are sent to one worker as a single task, so
+    that they reuse its operators and sensitivity images.
+
+    Parameters
+    ----------
+    studies : sequence of `dict`
+        Study descriptions, see the module documentation.
+    nworkers : positive `int`, optional
+        Number of worker processes. Default: number of CPUs.
+
+    Yields
+    ------
+    report : `dict`
+        Name, data size, iterations run by this call and timings of each
+        study, or its ``'error'``, in order of completion.
+    """
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    tasks = _group_studies(studies, nworkers)
+    pool = multiprocessing.Pool(nworkers, share_cores, (nworkers,))
+    try:
+        for reports in pool.imap_unordered(_run_group, tasks):
+            for report in reports:
+                yield report
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(argv=None):
+    """Entry point of the ``odlemrecon`` command."""
+    parser = argparse.ArgumentParser(
+        description='Batch reconstruction of EMrecon studies.')
+    parser.add_argument('manifest', help='JSON file listing the studies')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: CPUs)')
+    args = parser.parse_args(argv)
+
+    with open(args.manifest) as manifest_file:
+        studies = json.load(manifest_file)['studies']
+
+    start = time.time()
+    failed = 0
+    for report in run_manifest(studies, args.workers):
+        if 'error' in report:
+            failed += 1
+            print('{}: FAILED\n{}'.format(report['name'], report['error']),
+                  file=sys.stderr)
+        else:
+            rate = report['niter'] / report['time']
+            print('{}: {:.1f} s ({:.1f} s setup), {:.3f} iterations/s, '
+                  '{:.3g} data values/s'
+                  ''.format(report['name'], report['time'],
+                            report['setup_time'], rate,
+                            rate * report['size']))
+
+    elapsed = time.time() - start
+    print('{} studies in {:.1f} s, {:.3f} studies/min, {} failed'
+          ''.format(len(studies), elapsed, 60.0 * len(studies) / elapsed,
+                    failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
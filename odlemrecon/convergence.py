@@ -0,0 +1,157 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Convergence tracking of EM reconstructions.
+
+The Poisson log-likelihood of an iterate is computed from the forward
+projection the EM update needs anyway, so tracking it costs no extra
+projection. With ordered subsets, the log-likelihood of a pass is the sum
+over the subsets, each evaluated at the iterate the subset was applied to.
+"""
+
+import numpy as np
+
+from odlemrecon.em import osem
+
+__all__ = ('ConvergenceMonitor', 'monitored_mlem')
+
+
+class ConvergenceMonitor(object):
+
+    """Poisson log-likelihood and relative change per iteration.
+
+    Pass it as ``monitor`` to `osem` or the helpers running it.
+    """
+
+    def __init__(self, rtol=None, ltol=None, min_iter=1, eps=1e-8):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        rtol : positive `float`, optional
+            Stop when the relative change ``||x_k - x_{k-1}|| / ||x_{k-1}||``
+            of the iterate falls below ``rtol``.
+        ltol : positive `float`, optional
+            Stop when the log-likelihood increases by less than ``ltol``
+            times its magnitude.
+        min_iter : positive `int`, optional
+            Number of iterations done before stopping is considered.
+        eps : positive `float`, optional
+            Lower bound of the projection inside the logarithm.
+        """
+        self.rtol = rtol
+        self.ltol = ltol
+        self.min_iter = int(min_iter)
+        self.eps = eps
+        self.loglikelihood = []
+        self.relative_change = []
+        self._current = 0.0
+        self._previous = None
+
+    @property
+    def converged(self):
+        """Whether a stopping criterion was met in the last iteration."""
+        niter = len(self.loglikelihood)
+        if niter < max(self.min_iter, 2):
+            return False
+        if (self.rtol is not None and
+                self.relative_change[-1] < self.rtol):
+            return True
+        if self.ltol is not None:
+            gain = self.loglikelihood[-1] - self.loglikelihood[-2]
+            if gain < self.ltol * abs(self.loglikelihood[-1]):
+                return True
+        return False
+
+    def start(self, x):
+        """Remember the starting point of the iteration."""
+        self._previous = np.array(x, dtype='float32', copy=True)
+
+    def add_projection(self, proj, data):
+        """Add the log-likelihood of ``data`` given the projection ``proj``.
+
+        The constant ``-sum(log(data!))`` is left out.
+        """
+        proj = np.maximum(np.asarray(proj, dtype='float32'), self.eps)
+        data = np.asarray(data, dtype='float32')
+        # Elementwise in float32, accumulated in float64
+        self._current += (np.sum(data * np.log(proj), dtype='float64') -
+                          np.sum(proj, dtype='float64'))
+
+    def end_iteration(self, x):
+        """Record the metrics of an iteration that produced ``x``.
+
+        Returns
+        -------
+        converged : bool
+        """
+        x = np.asarray(x, dtype='float32')
+        if self._previous is None:
+            change = np.inf
+            self._previous = np.array(x, copy=True)
+        else:
+            diff = np.linalg.norm((x - self._previous).ravel())
+            change = diff / max(np.linalg.norm(self._previous.ravel()),
+                                self.eps)
+            self._previous[:] = x
+
+        self.loglikelihood.append(float(self._current))
+        self.relative_change.append(float(change))
+        self._current = 0.0
+        return self.converged
+
+
+def monitored_mlem(op, x, data, niter, sensitivities=None, callback=None,
+                   monitor=None, background=None, checkpointer=None):
+    """MLEM that stops at convergence.
+
+    Parameters
+    ----------
+    op : `Operator`
+        Forward operator.
+    x : ``op.domain`` element
+        Starting point, updated in place.
+    data : ``op.range`` `element-like`
+        Measured data.
+    niter : positive `int`
+        Maximum number of iterations.
+    sensitivities : `float` or ``op.domain`` `element-like`, optional
+        Default: `sensitivity_image` of ``op``.
+    callback : `callable`, optional
+        Called with the current iterate after each iteration.
+    monitor : `ConvergenceMonitor`, optional
+        Records the metrics of the iterates and decides when to stop.
+        Default: run ``niter`` iterations.
+    background : ``op.range`` `element-like`, optional
+        Fixed additive term of the expected data, e.g. scatter, randoms or
+        activity outside the reconstructed volume.
+    checkpointer : `Checkpointer`, optional
+        See `osem`.
+
+    Returns
+    -------
+    niter : `int`
+        Number of iterations done.
+    """
+    if sensitivities is not None and not np.isscalar(sensitivities):
+        # One subset, so that an image is taken as sensitivity
+        sensitivities = [sensitivities]
+    if background is not None:
+        background = [background]
+    return osem([op], x, [data], niter, sensitivities=sensitivities,
+                background=background, callback=callback, monitor=monitor,
+                checkpointer=checkpointer)
@@ -0,0 +1,489 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Distributed list-mode projection over a pool of worker processes.
+
+A dispatcher holds a job queue and one result queue per client. Workers,
+possibly on other hosts, take jobs from the queue, run the EMrecon tools and
+put the results back. Each client operator splits its events into shards,
+submits one job per shard and reduces the results.
+
+Jobs and results are exchanged as pickles, so anyone who can connect to
+the dispatcher can run code on it and on every worker. Dispatchers on
+other addresses than localhost therefore require a shared secret, taken
+from ``$ODLEMRECON_AUTHKEY`` or passed as ``authkey``. On localhost the
+secret defaults to the authentication key of the current process, which
+its child processes inherit.
+
+Run a dispatcher and workers from the command line, with the same secret
+in ``$ODLEMRECON_AUTHKEY``, with::
+
+    python -m odlemrecon.distributed dispatcher --address 10.0.0.1:50000
+    python -m odlemrecon.distributed worker --address 10.0.0.1:50000
+
+Only listen on interfaces of a trusted network.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import multiprocessing
+import os
+import traceback
+import uuid
+from multiprocessing.managers import BaseManager
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+import odl
+
+from odlemrecon.emreconoperators import EMReconForwardProjectorList
+
+__all__ = ('start_dispatcher', 'start_local_workers', 'run_worker',
+           'ProjectionClient', 'DistributedForwardProjectorList',
+           'DistributedBackProjectorList')
+
+
+# --- Dispatcher --- #
+
+_JOBS = queue.Queue()
+_RESULTS = collections.defaultdict(queue.Queue)
+
+
+def _get_jobs():
+    return _JOBS
+
+
+def _get_results(client_id):
+    return _RESULTS[client_id]
+
+
+class _DispatcherManager(BaseManager):
+    pass
+
+
+_DispatcherManager.register('get_jobs', callable=_get_jobs)
+_DispatcherManager.register('get_results', callable=_get_results)
+
+
+_LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+
+def _parse_address(address):
+    """Turn ``'host:port'`` into ``(host, port)``."""
+    if isinstance(address, tuple):
+        return address
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def _authkey(authkey, address):
+    """Return the shared secret for a dispatcher at ``address``.
+
+    ``None`` stands for the authentication key of the current process and
+    is only accepted on localhost.
+    """
+    if authkey is None and os.environ.get('ODLEMRECON_AUTHKEY'):
+        authkey = os.environ['ODLEMRECON_AUTHKEY'].encode('utf-8')
+    if authkey is None and _parse_address(address)[0] not in _LOCAL_HOSTS:
+        raise ValueError('a dispatcher on {!r} needs a shared secret, set '
+                         '$ODLEMRECON_AUTHKEY or pass `authkey`'
+                         ''.format(address))
+    return authkey
+
+
+def start_dispatcher(address=('localhost', 0), authkey=None):
+    """Start a dispatcher in a background process.
+
+    Parameters
+    ----------
+    address : `tuple` or `str`, optional
+        Address to listen on, port 0 picks a free port.
+    authkey : `bytes`, optional
+        Shared secret. Default: ``$ODLEMRECON_AUTHKEY``, required unless
+        ``address`` is on localhost.
+
+    Returns
+    -------
+    manager : `multiprocessing.managers.BaseManager`
+        The running dispatcher, see its ``address`` attribute. Stop it with
+        ``manager.shutdown()``.
+    """
+    manager = _DispatcherManager(address=_parse_address(address),
+                                 authkey=_authkey(authkey, address))
+    manager.start()
+    return manager
+
+
+def _connect(address, authkey):
+    manager = _DispatcherManager(address=_parse_address(address),
+                                 authkey=_authkey(authkey, address))
+    manager.connect()
+    return manager
+
+
+# --- Workers --- #
+
+def _load_geometry(geometry):
+    """Resolve a geometry sent by `_geometry_ref`."""
+    if isinstance(geometry, dict):
+        return np.memmap(geometry['filename'], dtype=geometry['dtype'],
+                         mode='r', offset=geometry['offset'],
+                         shape=geometry['shape'])
+    else:
+        return geometry
+
+
+def _geometry_ref(geometry):
+    """Return a picklable reference to a geometry shard.
+
+    Shards of memory-mapped files are sent as file references, which avoids
+    transferring the events when the workers share the file system.
+    """
+    if isinstance(geometry, np.memmap) and geometry.filename is not None:
+        base = geometry
+        while (isinstance(base.base, np.memmap) and
+               base.base.filename == geometry.filename):
+            base = base.base
+        if geometry.flags.c_contiguous:
+            offset = (geometry.__array_interface__['data'][0] -
+                      base.__array_interface__['data'][0] + base.offset)
+            return {'filename': geometry.filename,
+                    'dtype': geometry.dtype.str,
+                    'offset': offset,
+                    'shape': geometry.shape}
+    return np.asarray(geometry)
+
+
+class _Worker(object):
+
+    """Executes projection jobs, caching operators by geometry."""
+
+    def __init__(self, cache_size=8):
+        self.cache_size = cache_size
+        self.ops = collections.OrderedDict()
+
+    def operator(self, job):
+        key = job['key']
+        if key in self.ops:
+            self.ops[key] = self.ops.pop(key)
+        else:
+            min_pt, max_pt, shape, dtype = job['domain']
+            domain = odl.uniform_discr(min_pt, max_pt, shape, dtype=dtype)
+            geometry = _load_geometry(job['geometry'])
+            ran = odl.rn(len(geometry), dtype='float32')
+            fwd = EMReconForwardProjectorList(domain, ran, geometry,
+                                              settings=dict(job['settings']))
+            self.ops[key] = (fwd, fwd.adjoint)
+            if len(self.ops) > self.cache_size:
+                self.ops.popitem(last=False)
+        return self.ops[key]
+
+    def __call__(self, job):
+        fwd, back = self.operator(job)
+        if job['kind'] == 'forward':
+            return np.asarray(fwd(job['values']), dtype='float32')
+        else:
+            return np.asarray(back(job['values']), dtype='float32')
+
+
+def run_worker(address, authkey=None, cache_size=8):
+    """Execute jobs from a dispatcher until told to stop.
+
+    Parameters
+    ----------
+    address : `tuple` or `str`
+        Address of the dispatcher.
+    authkey : `bytes`, optional
+        Shared secret. Default: ``$ODLEMRECON_AUTHKEY``.
+    cache_size : positive `int`, optional
+        Number of operators kept between jobs.
+    """
+    manager = _connect(address, authkey)
+    jobs = manager.get_jobs()
+    results = {}
+    worker = _Worker(cache_size)
+    while True:
+        job = jobs.get()
+        if job is None:
+            # Sentinel from `ProjectionClient.stop_workers`
+            break
+        try:
+            result = ('ok', worker(job))
+        except Exception:
+            result = ('error', traceback.format_exc())
+        if job['client'] not in results:
+            results[job['client']] = manager.get_results(job['client'])
+        results[job['client']].put((job['id'], result))
+
+
+def start_local_workers(address, nworkers=None, authkey=None):
+    """Start worker processes on this host.
+
+    Parameters
+    ----------
+    address : `tuple` or `str`
+        Address of the dispatcher.
+    nworkers : positive `int`, optional
+        Number of workers. Default: number of CPUs.
+    authkey : `bytes`, optional
+        Shared secret. Default: ``$ODLEMRECON_AUTHKEY``.
+
+    Returns
+    -------
+    workers : `list` of `multiprocessing.Process`
+    """
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    workers = []
+    for _ in range(nworkers):
+        worker = multiprocessing.Process(target=run_worker,
+                                         args=(address, authkey))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+# --- Client --- #
+
+class ProjectionClient(object):
+
+    """Connection of a client to a dispatcher."""
+
+    def __init__(self, address, authkey=None, timeout=600.0, retries=1):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        address : `tuple` or `str`
+            Address of the dispatcher.
+        authkey : `bytes`, optional
+            Shared secret. Default: ``$ODLEMRECON_AUTHKEY``.
+        timeout : positive `float`, optional
+            Seconds to wait for the next result. The jobs still pending
+            then, e.g. those of a worker that died, are submitted again.
+            ``None`` waits forever.
+        retries : nonnegative `int`, optional
+            Number of times pending jobs are submitted again before
+            `RuntimeError` is raised.
+        """
+        self.address = address
+        self.timeout = timeout
+        self.retries = int(retries)
+        self.client_id = uuid.uuid4().hex
+        self._manager = _connect(address, authkey)
+        self._jobs = self._manager.get_jobs()
+        self._results = self._manager.get_results(self.client_id)
+
+    def run(self, jobs):
+        """Submit ``jobs`` and return their results in order."""
+        ids = []
+        submitted = {}
+        for job in jobs:
+            job = dict(job, id=uuid.uuid4().hex, client=self.client_id)
+            ids.append(job['id'])
+            submitted[job['id']] = job
+            self._jobs.put(job)
+
+        pending = set(ids)
+        results = {}
+        attempt = 0
+        while pending:
+            try:
+                job_id, (status, value) = self._results.get(
+                    timeout=self.timeout)
+            except queue.Empty:
+                if attempt == self.retries:
+                    raise RuntimeError('no result from the workers within '
+                                       '{} s, {} jobs pending'
+                                       ''.format(self.timeout, len(pending)))
+                attempt += 1
+                # Lost with a worker, duplicate results are skipped below
+                for job_id in pending:
+                    self._jobs.put(submitted[job_id])
+                continue
+            if job_id not in pending:
+                # Duplicate, or left over from an earlier call that failed
+                continue
+            if status != 'ok':
+                raise RuntimeError('projection failed on a worker:\n{}'
+                                   ''.format(value))
+            pending.remove(job_id)
+            results[job_id] = value
+        return [results[job_id] for job_id in ids]
+
+    def stop_workers(self, nworkers):
+        """Ask ``nworkers`` workers to exit."""
+        for _ in range(nworkers):
+            self._jobs.put(None)
+
+
+class _DistributedListBase(odl.Operator):
+
+    """Common setup of the distributed list-mode operators."""
+
+    def __init__(self, domain, range, volume_space, geometry, settings,
+                 client, nshards):
+        self.volume_space = volume_space
+        self.geometry = geometry
+        self.settings = dict(settings)
+        self.client = client
+        self.nshards = int(nshards)
+
+        bounds = np.linspace(0, len(geometry), self.nshards + 1)
+        self.bounds = bounds.astype('int64')
+
+        domain_desc = (list(volume_space.min_pt), list(volume_space.max_pt),
+                       list(volume_space.shape), str(volume_space.dtype))
+        self._shards = []
+        for start, stop in zip(self.bounds[:-1], self.bounds[1:]):
+            self._shards.append({
+                'key': uuid.uuid4().hex,
+                'domain': domain_desc,
+                'settings': self.settings,
+                'geometry': _geometry_ref(geometry[start:stop])})
+        odl.Operator.__init__(self, domain, range, linear=True)
+
+
+class DistributedForwardProjectorList(_DistributedListBase):
+
+    """List-mode forward projection computed by remote workers.
+
+    The events are split into ``nshards`` contiguous shards, each projected
+    by one job, and the results are concatenated.
+    """
+
+    def __init__(self, domain, range, geometry, settings, client, nshards):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        domain : `DiscreteLp`
+            The volume space.
+        range : `TensorSpace`
+            The list-mode data space.
+        geometry : `array-like`, shape ``(n, 6)``
+            The lines of response, see `EMReconForwardProjectorList`.
+        settings : `dict`
+            EMRecon settings.
+        client : `ProjectionClient`
+            Connection to the dispatcher.
+        nshards : positive `int`
+            Number of jobs per projection.
+        """
+        _DistributedListBase.__init__(self, domain, range, domain, geometry,
+                                      settings, client, nshards)
+
+    def _call(self, volume):
+        volume = np.asarray(volume, dtype='float32')
+        jobs = [dict(shard, kind='forward', values=volume)
+                for shard in self._shards]
+        return np.concatenate(self.client.run(jobs))
+
+    @property
+    def adjoint(self):
+        op = DistributedBackProjectorList(
+            self.range, self.domain, self.geometry, self.settings,
+            self.client, self.nshards)
+        # Reuse the operators cached by the workers
+        op._shards = self._shards
+        return op
+
+
+class DistributedBackProjectorList(_DistributedListBase):
+
+    """List-mode back-projection computed by remote workers.
+
+    Each shard of events is back-projected by one job and the partial
+    volumes are summed.
+    """
+
+    def __init__(self, domain, range, geometry, settings, client, nshards):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        domain : `TensorSpace`
+            The list-mode data space.
+        range : `DiscreteLp`
+            The volume space.
+        geometry : `array-like`, shape ``(n, 6)``
+            The lines of response, see `EMReconForwardProjectorList`.
+        settings : `dict`
+            EMRecon settings.
+        client : `ProjectionClient`
+            Connection to the dispatcher.
+        nshards : positive `int`
+            Number of jobs per projection.
+        """
+        _DistributedListBase.__init__(self, domain, range, range, geometry,
+                                      settings, client, nshards)
+
+    def _call(self, sinogram):
+        sinogram = np.asarray(sinogram, dtype='float32')
+        jobs = [dict(shard, kind='backward', values=sinogram[start:stop])
+                for shard, start, stop in zip(self._shards, self.bounds[:-1],
+                                              self.bounds[1:])]
+        results = self.client.run(jobs)
+
+        backproj = results[0]
+        for partial in results[1:]:
+            backproj += partial
+        return backproj
+
+    @property
+    def adjoint(self):
+        op = DistributedForwardProjectorList(
+            self.range, self.domain, self.geometry, self.settings,
+            self.client, self.nshards)
+        op._shards = self._shards
+        return op
+
+
+def main(argv=None):
+    """Run a dispatcher or a worker from the command line."""
+    parser = argparse.ArgumentParser(
+        description='Distributed EMrecon projection.')
+    parser.add_argument('role', choices=['dispatcher', 'worker'])
+    parser.add_argument('--address', default='localhost:50000',
+                        help='host:port of the dispatcher')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes to start')
+    args = parser.parse_args(argv)
+    if not os.environ.get('ODLEMRECON_AUTHKEY'):
+        # Separate processes cannot share the key of a process
+        parser.error('set $ODLEMRECON_AUTHKEY to a shared secret')
+
+    if args.role == 'dispatcher':
+        manager = _DispatcherManager(
+            address=_parse_address(args.address),
+            authkey=_authkey(None, args.address))
+        manager.get_server().serve_forever()
+    else:
+        workers = start_local_workers(args.address, args.workers)
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Dynamic reconstruction of the time frames of one list-mode acquisition.
+
+Frames are given as ranges of event indices into a single event store, a
+.l file or array of ``n x 7`` float32 events in acquisition order. All
+frames share the volume space, the settings file and the sensitivity,
+and are reconstructed concurrently. The result is a float32 ``.npy``
+file of shape ``(nframes,) + space.shape`` that is memory-mapped instead
+of held in memory.
+"""
+
+import multiprocessing
+
+import numpy as np
+
+from odlemrecon.emreconoperators import EMReconForwardProjectorList
+from odlemrecon.listmode import memmap_events, partition_events
+from odlemrecon.pipeline import pipelined_osmlem
+from odlemrecon.scratch import default_scratch
+from odlemrecon.scheduler import share_cores
+from odlemrecon.util import listmode_space
+
+__all__ = ('frames_from_counts', 'dynamic_reconstruction')
+
+
+def frames_from_counts(counts):
+    """Return event index ranges of consecutive frames.
+
+    Parameters
+    ----------
+    counts : sequence of `int`
+        Number of events per frame, e.g. from the time marks of the
+        acquisition.
+
+    Returns
+    -------
+    frames : `list` of ``(start, stop)`` tuples
+    """
+    stops = np.cumsum(counts)
+    starts = stops - np.asarray(counts)
+    return [(int(start), int(stop)) for start, stop in zip(starts, stops)]
+
+
+def _reconstruct_frame(task):
+    """Pool task reconstructing one frame into the output file."""
+    (store, index, start, stop, space, settings, niter, subsets,
+     sensitivities, out_file, memory_budget) = task
+    events = memmap_events(store)[start:stop]
+    geometry, values = partition_events(events, subsets,
+                                        memory_budget=memory_budget)
+    op = [EMReconForwardProjectorList(space, listmode_space(len(geom)), geom,
+                                      settings=dict(settings),
+                                      memory_budget=memory_budget)
+          for geom in geometry]
+
+    if isinstance(sensitivities, str):
+        # Shared image, scaled to the fraction of the frame in each subset
+        sens = np.load(sensitivities, mmap_mode='r')
+        sensitivities = [float(len(geom)) / (stop - start) * sens
+                         for geom in geometry]
+
+    x = space.one()
+    pipelined_osmlem(op, x, values, niter=niter, sensitivities=sensitivities)
+
+    out = np.load(out_file, mmap_mode='r+')
+    out[index] = x
+    out.flush()
+
+
+def dynamic_reconstruction(events, frames, space, out_file, settings=None,
+                           niter=3, subsets=1, sensitivities=1.0,
+                           nworkers=None, memory_budget=None):
+    """Reconstruct the time frames of a list-mode acquisition.
+
+    Parameters
+    ----------
+    events : `str` or `array-like`
+        The event store, a .l file or ``n x 7`` array of events in
+        acquisition order. Arrays are written once to scratch space so
+        that the workers can memory-map them.
+    frames : sequence of ``(start, stop)``
+        Event index range of each frame, see `frames_from_counts`.
+    space : `DiscreteLp`
+        Volume space shared by all frames.
+    out_file : `str`
+        Name of the ``.npy`` file the frames are written to.
+    settings : `dict`, optional
+        EMRecon settings, e.g. ``{'SCANNERTYPE': 1}``.
+    niter : positive `int`, optional
+        Number of passes over all subsets per frame.
+    subsets : positive `int`, optional
+        Number of ordered subsets per frame.
+    sensitivities : `float` or `array-like`, optional
+        Sensitivity image of the scanner, shared by all frames and divided
+        among the subsets of a frame by their share of its events. A
+        `float` is used for every subset as it is. Frames keep their
+        counts, so the volumes are proportional to the activity times the
+        frame duration; divide by the durations for activity
+        concentrations. Default: 1.0.
+    nworkers : positive `int`, optional
+        Number of worker processes. Default: the smaller of the number of
+        frames and of CPUs.
+    memory_budget : positive `int`, optional
+        Bytes held by the projections of each worker, see
+        `EMReconForwardProjectorList`.
+
+    Returns
+    -------
+    volumes : `numpy.memmap`
+        The reconstructed frames, shape ``(nframes,) + space.shape``.
+    """
+    settings = {} if settings is None else settings
+    frames = [(int(start), int(stop)) for start, stop in frames]
+    scratch = default_scratch()
+
+    if isinstance(events, str):
+        store, store_file = events, None
+    else:
+        events = np.ascontiguousarray(events, dtype='float32')
+        store_file = scratch.file(events.nbytes)
+        store_file.seek(0)
+        store_file.write(events.data)
+        store_file.flush()
+        store = store_file.name
+
+    sens_file = None
+    if not np.isscalar(sensitivities):
+        # Shared by the workers through a memory-mapped file
+        sens_file = scratch.file()
+        sens = np.lib.format.open_memmap(sens_file.name, mode='w+',
+                                         dtype='float32', shape=space.shape)
+        sens[:] = sensitivities
+        sens.flush()
+        del sens
+        sensitivities = sens_file.name
+
+    out = np.lib.format.open_memmap(out_file, mode='w+', dtype='float32',
+                                    shape=(len(frames),) + space.shape)
+    del out
+
+    if nworkers is None:
+        nworkers = min(len(frames), multiprocessing.cpu_count())
+    tasks = [(store, i, start, stop, space, settings, niter, subsets,
+              sensitivities, out_file, memory_budget)
+             for i, (start, stop) in enumerate(frames)]
+    pool = multiprocessing.Pool(nworkers, share_cores, (nworkers,))
+    try:
+        pool.map(_reconstruct_frame, tasks)
+    finally:
+        pool.close()
+        pool.join()
+        for scratch_file in (store_file, sens_file):
+            if scratch_file is not None:
+                scratch_file.release()
+
+    return np.load(out_file, mmap_mode='r+')
@@ -0,0 +1,185 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The EM iteration shared by the reconstruction helpers.
+
+`osem` is the ordered-subsets MLEM update of `odl.solvers.osmlem`, with an
+additive background, convergence monitoring and checkpointing. MLEM is the
+case of a single subset. The helpers of the other modules, e.g.
+`monitored_mlem`, `checkpointed_mlem` and `pipelined_osmlem`, all run it.
+"""
+
+import numpy as np
+
+__all__ = ('osem', 'em_backprojection', 'sensitivity_image')
+
+
+# Lower bound of the iterate, the sensitivities and the expected data, as in
+# `odl.solvers.osmlem`
+_EPS = 1e-8
+
+
+def sensitivity_image(op):
+    """Return the back-projection of ones ``op^* 1``, clipped to positive.
+
+    Parameters
+    ----------
+    op : `Operator`
+        Forward operator. List-mode projectors compute the image chunk by
+        chunk, without the ones of all events.
+    """
+    if hasattr(op, 'sensitivity_image'):
+        return op.sensitivity_image()
+    return np.maximum(np.asarray(op.adjoint(op.range.one())), _EPS)
+
+
+def em_backprojection(op, x, data, background=None, monitor=None):
+    """Return the EM correction ``op^*(data / (op(x) + background))``.
+
+    List-mode projectors compute it chunk by chunk, see
+    `EMReconForwardProjectorList.em_backprojection`, so that with a
+    ``memory_budget`` nothing of the size of the events is held in memory.
+
+    Parameters
+    ----------
+    op : `Operator`
+        Forward operator.
+    x : ``op.domain`` `element-like`
+        Current iterate.
+    data : ``op.range`` `element-like`
+        Measured data.
+    background : ``op.range`` `element-like`, optional
+        Fixed additive term of the expected data.
+    monitor : `ConvergenceMonitor`, optional
+        Gets the expected data through ``add_projection``.
+    """
+    if hasattr(op, 'em_backprojection'):
+        return op.em_backprojection(x, data, background, monitor)
+    return _plain_em_backprojection(op, x, data, background, monitor)
+
+
+def _plain_em_backprojection(op, x, data, background, monitor):
+    """Return the EM correction with one forward and one adjoint call."""
+    proj = np.asarray(op(x))
+    if background is not None:
+        proj = proj + np.asarray(background)
+    data = np.asarray(data)
+    if monitor is not None:
+        monitor.add_projection(proj, data)
+    return np.asarray(op.adjoint(data / np.maximum(proj, _EPS)))
+
+
+def osem(op, x, data, niter, sensitivities=None, background=None,
+         callback=None, monitor=None, checkpointer=None, pipeline=None):
+    """Ordered-subsets MLEM.
+
+    Parameters
+    ----------
+    op : sequence of `Operator`
+        One forward operator per subset, all with the same domain.
+    x : ``op[0].domain`` element
+        Starting point of the iteration, updated in place. Overwritten by
+        the latest checkpoint if there is one.
+    data : sequence of `array-like`
+        Measured data per subset.
+    niter : positive `int`
+        Maximum number of passes over all subsets, including those before
+        a checkpoint.
+    sensitivities : `float` or sequence, optional
+        Sensitivity per subset, a `float` is used for every subset.
+        Default: `sensitivity_image` of each subset operator.
+    background : sequence of `array-like`, optional
+        Fixed additive term of the expected data per subset, e.g. scatter,
+        randoms or activity outside the reconstructed volume.
+    callback : `callable`, optional
+        Called with ``x`` after each subset.
+    monitor : `ConvergenceMonitor`, optional
+        Records the metrics of each pass over the subsets and stops the
+        iteration at convergence.
+    checkpointer : `Checkpointer`, optional
+        If given, the iteration continues from its latest checkpoint, stores
+        the iterate every ``checkpointer.interval`` subsets and caches the
+        computed sensitivities. Checkpoints of a run with another number of
+        subsets or other shapes are refused, see `Checkpointer.check`.
+    pipeline : `ListModeSubsetPipeline`, optional
+        Projects the subsets instead of ``op``, staging the next subset
+        while the current one is projected.
+
+    Returns
+    -------
+    niter : `int`
+        Number of passes done, including those before a checkpoint.
+    """
+    nsubsets = len(op)
+    if len(data) != nsubsets:
+        raise ValueError('`data` has {} subsets, expected {}'
+                         ''.format(len(data), nsubsets))
+    if background is None:
+        background = [None] * nsubsets
+    if checkpointer is not None:
+        checkpointer.check({'subsets': nsubsets,
+                            'shape': list(np.shape(x)),
+                            'data_sizes': [int(np.size(data_i))
+                                           for data_i in data]})
+
+    if sensitivities is None:
+        def compute_sensitivities():
+            return [sensitivity_image(op_i) for op_i in op]
+
+        if checkpointer is None:
+            sensitivities = compute_sensitivities()
+        else:
+            sensitivities = checkpointer.cached('sensitivities',
+                                                compute_sensitivities)
+    elif np.isscalar(sensitivities):
+        sensitivities = [sensitivities] * nsubsets
+
+    start = 0 if checkpointer is None else checkpointer.restore(x)
+    nsteps = niter * nsubsets
+    iterate = np.maximum(np.asarray(x, dtype='float32'), _EPS)
+    if monitor is not None:
+        monitor.start(iterate)
+
+    if pipeline is not None and start < nsteps:
+        pipeline.prefetch(start % nsubsets)
+    done = start
+    for step in range(start, nsteps):
+        i = step % nsubsets
+        if pipeline is None:
+            backproj = em_backprojection(op[i], iterate, data[i],
+                                         background[i], monitor)
+        else:
+            if step + 1 < nsteps:
+                pipeline.prefetch((i + 1) % nsubsets)
+            backproj = pipeline.em_backprojection(i, iterate, background[i],
+                                                  monitor)
+        iterate *= backproj
+        iterate /= sensitivities[i]
+
+        x[:] = iterate
+        done = step + 1
+        if checkpointer is not None:
+            checkpointer.step(done, iterate)
+        if callback is not None:
+            callback(x)
+        if (monitor is not None and i == nsubsets - 1 and
+                monitor.end_iteration(iterate)):
+            break
+
+    if checkpointer is not None and start < done:
+        checkpointer.finish(done, iterate)
+    return -(-done // nsubsets)
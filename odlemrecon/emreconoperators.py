@@ -18,18 +18,90 @@
 """Operators for EMRecon - ODL bindings."""
 
 
-import tempfile
+import copy
+
 import odl
 import numpy as np
-import os
 
-from odlemrecon.util import settings_from_domain, make_settings_file
+from odlemrecon.em import _EPS, _plain_em_backprojection
+from odlemrecon.launcher import default_launcher
+from odlemrecon.scratch import default_scratch
+from odlemrecon.util import (settings_from_domain, make_settings_file,
+                             listmode_space)
 
 __all__ = ('EMReconForwardProjector', 'EMReconBackProjector',
            'EMReconAttenuationCorrection', 'EMReconScatteringSimulation',
            'EMReconForwardProjectorList', 'EMReconBackProjectorList')
 
 
+def _write_fortran(file, array):
+    """Write ``array`` to ``file`` as float32 in Fortran order.
+
+    This is the layout EMrecon uses. Float32 arrays in Fortran order are
+    written without any copy.
+    """
+    array = np.asfortranarray(array, dtype='float32')
+    file.seek(0)
+    # The transpose is C-contiguous, its buffer is the Fortran-ordered data
+    file.write(array.T.data)
+    file.flush()
+
+
+def _read_fortran(file_name, shape):
+    """Read a float32 array in Fortran order, the layout of EMrecon."""
+    return np.fromfile(file_name, dtype='float32').reshape(shape, order='F')
+
+
+def _events(geometry):
+    """Return a float32 ``n x 7`` event array with zero values.
+
+    Rows are ``[px_1, py_1, pz_1, px_2, py_2, pz_2, val]``, C-ordered as
+    EMrecon reads them.
+    """
+    events = np.empty((len(geometry), 7), dtype='float32')
+    events[:, :6] = geometry
+    events[:, 6] = 0
+    return events
+
+
+# Bytes per event held in memory while projecting: the event buffer, the
+# EMrecon output read back, and the projection, data, ratio and one
+# temporary of the EM update
+_EVENT_BYTES = 4 * (2 * 7 + 4)
+
+
+def _chunk_size(memory_budget, nevents, volume_size):
+    """Return the number of events projected at once within the budget."""
+    if memory_budget is None:
+        return nevents
+    # Besides the events, a volume is written, read and accumulated
+    available = int(memory_budget) - 3 * 4 * volume_size
+    if available < _EVENT_BYTES:
+        raise ValueError('`memory_budget` of {} bytes too small for a volume '
+                         'of {} voxels'.format(memory_budget, volume_size))
+    return max(1, min(nevents, available // _EVENT_BYTES))
+
+
+def _write_events(file, buffer, geometry, start, stop, values=0):
+    """Write events ``start:stop`` to ``file``, sized to fit exactly."""
+    events = buffer[:stop - start]
+    events[:, :6] = geometry[start:stop]
+    events[:, 6] = values
+    if file.size != events.nbytes:
+        file.resize(events.nbytes)
+    file.seek(0)
+    file.write(events.data)
+    file.flush()
+
+
+def _run_emrecon(tool, option, *args):
+    """Run an EMrecon tool, selecting ``option`` in its menu.
+
+    Raises `EMReconError` if the tool fails, see `default_launcher`.
+    """
+    default_launcher().run(tool, option, *args)
+
+
 class EMReconForwardProjector(odl.Operator):
     def __init__(self, domain, range, settings=None, settings_file_name=None):
         if settings_file_name is None and settings is None:
@@ -41,26 +113,21 @@ class EMReconForwardProjector(odl.Operator):
             settings_file_name = make_settings_file(settings)
 
         self.settings_file_name = settings_file_name
-        self.volume_file = tempfile.NamedTemporaryFile(mode='w+')
-        self.sinogram_file = tempfile.NamedTemporaryFile(mode='r')
+        scratch = default_scratch()
+        self.volume_file = scratch.file(4 * domain.size)
+        self.sinogram_file = scratch.file(4 * range.size)
         odl.Operator.__init__(self, domain, range, linear=True)
 
     def _call(self, volume):
         # Copy volume to disk
-        fortranvolume = np.asfortranarray(volume, dtype='float32')
-        fortranvolume = fortranvolume.swapaxes(0, 2)
-        self.volume_file.seek(0)
-        self.volume_file.write(fortranvolume.tobytes())
-        self.volume_file.flush()
+        _write_fortran(self.volume_file, volume)
 
-        command = 'echo "4" | EMrecon_siemens_pet_tools {} {} {} > /dev/null'.format(
-            self.settings_file_name,
-            self.volume_file.name,
-            self.sinogram_file.name)
-        os.system(command)
+        _run_emrecon('EMrecon_siemens_pet_tools', 4,
+                     self.settings_file_name,
+                     self.volume_file.name,
+                     self.sinogram_file.name)
 
-        sinogram = np.fromfile(self.sinogram_file.name, dtype='float32')
-        sinogram = sinogram.reshape(self.range.shape, order='F')
+        sinogram = _read_fortran(self.sinogram_file.name, self.range.shape)
 
         return sinogram
 
@@ -82,25 +149,20 @@ class EMReconBackProjector(odl.Operator):
             settings_file_name = make_settings_file(settings)
 
         self.settings_file_name = settings_file_name
-        self.sinogram_file = tempfile.NamedTemporaryFile(mode='w+')
-        self.backproj_file = tempfile.NamedTemporaryFile(mode='r')
+        scratch = default_scratch()
+        self.sinogram_file = scratch.file(4 * domain.size)
+        self.backproj_file = scratch.file(4 * range.size)
         odl.Operator.__init__(self, domain, range, linear=True)
 
     def _call(self, sinogram):
-        fortransinogram = np.asfortranarray(sinogram, dtype='float32')
-        fortransinogram = fortransinogram.swapaxes(0, 2)
-        self.sinogram_file.seek(0)
-        self.sinogram_file.write(fortransinogram.tobytes())
-        self.sinogram_file.flush()
+        _write_fortran(self.sinogram_file, sinogram)
 
-        command = 'echo "5" | EMrecon_siemens_pet_tools {} {} {} > /dev/null'.format(
-            self.settings_file_name,
-            self.sinogram_file.name,
-            self.backproj_file.name)
-        os.system(command)
+        _run_emrecon('EMrecon_siemens_pet_tools', 5,
+                     self.settings_file_name,
+                     self.sinogram_file.name,
+                     self.backproj_file.name)
 
-        backproj = np.fromfile(self.backproj_file.name, dtype='float32')
-        backproj = backproj.reshape(self.range.shape, order='F')
+        backproj = _read_fortran(self.backproj_file.name, self.range.shape)
 
         # Scale the adjoint properly
         backproj /= self.range.cell_volume
@@ -115,85 +177,227 @@ class EMReconBackProjector(odl.Operator):
 
 
 class EMReconForwardProjectorList(odl.Operator):
-    def __init__(self, domain, range, geometry, settings):
+    def __init__(self, domain, range, geometry, settings, memory_budget=None):
+        """Initialize a new instance.
+
+        ``memory_budget`` limits the bytes held in memory by a projection.
+        The events are then projected in chunks, with ``geometry`` best
+        memory-mapped, e.g. from `memmap_events`.
+        """
         settings.update(settings_from_domain(domain))
         settings_file_name = make_settings_file(settings)
 
         self.settings = settings
         self.settings_file_name = settings_file_name
         self.geometry = geometry
-        self.volume_file = tempfile.NamedTemporaryFile(mode='w+')
-        self.sinogram_file = tempfile.NamedTemporaryFile(mode='r')
+        self.memory_budget = memory_budget
+        self.chunk_size = _chunk_size(memory_budget, range.size, domain.size)
+        scratch = default_scratch()
+        self.volume_file = scratch.file(4 * domain.size)
+        self.sinogram_file = scratch.file(4 * 7 * self.chunk_size)
 
         # Create reference sinogram file
-        npsinogram = np.asarray(range.zero(), dtype='float32')
-        sinogram_with_geom = np.hstack((self.geometry, npsinogram[:, None]))
-        fortransinogram = np.asfortranarray(sinogram_with_geom,
-                                            dtype='float32')
-        self.reference_sinogram_file = tempfile.NamedTemporaryFile(mode='w+')
-        self.reference_sinogram_file.write(fortransinogram.tobytes())
-        self.reference_sinogram_file.flush()
+        self.reference_sinogram_file = scratch.file(4 * 7 * self.chunk_size)
+        if self.chunk_size == range.size:
+            self.reference_sinogram_file.seek(0)
+            self.reference_sinogram_file.write(_events(self.geometry).data)
+            self.reference_sinogram_file.flush()
+        self._buffer = None
+        self._em_files = None
 
         odl.Operator.__init__(self, domain, range, linear=True)
 
-    def _call(self, volume):
-        # Copy volume to disk
-        fortranvolume = np.asfortranarray(volume, dtype='float32')
-        fortranvolume = fortranvolume.swapaxes(0, 2)
-        self.volume_file.seek(0)
-        self.volume_file.write(fortranvolume.tobytes())
-        self.volume_file.flush()
+    def _project(self):
+        """Run the projection of the current reference file."""
+        _run_emrecon('EMrecon_artificial_tools', 3,
+                     self.settings_file_name,
+                     self.volume_file.name,
+                     self.reference_sinogram_file.name,
+                     self.sinogram_file.name)
+
+    def _backproject_chunks(self, values):
+        """Return the adjoint applied chunk by chunk.
+
+        ``values(start, stop)`` returns the values of events ``start:stop``.
+        """
+        if self._buffer is None:
+            self._buffer = np.empty((self.chunk_size, 7), dtype='float32')
+        if self._em_files is None:
+            scratch = default_scratch()
+            self._em_files = (scratch.file(4 * 7 * self.chunk_size),
+                              scratch.file(4 * self.domain.size))
+        events_file, backproj_file = self._em_files
+
+        backproj = np.zeros(self.domain.shape, dtype='float32')
+        for start in range(0, self.range.size, self.chunk_size):
+            stop = min(start + self.chunk_size, self.range.size)
+            chunk_values = values(start, stop)
+            _write_events(events_file, self._buffer, self.geometry, start,
+                          stop, chunk_values)
+            _run_emrecon('EMrecon_artificial_tools', 4,
+                         self.settings_file_name,
+                         events_file.name,
+                         backproj_file.name)
+            backproj += _read_fortran(backproj_file.name, self.domain.shape)
 
-        command = 'echo "3" | EMrecon_artificial_tools {} {} {} {} > /dev/null'.format(
-            self.settings_file_name,
-            self.volume_file.name,
-            self.reference_sinogram_file.name,
-            self.sinogram_file.name)
-        os.system(command)
+        # Scale the adjoint properly
+        backproj /= self.domain.cell_volume
 
-        sinogram = np.fromfile(self.sinogram_file.name, dtype='float32')
-        sinogram = sinogram.reshape([self.range.size, 7], order='C')
+        return backproj
 
-        return sinogram[:, -1]
+    def em_backprojection(self, volume, data, background=None, monitor=None):
+        """Return the EM correction ``A^*(data / (A volume + background))``.
+
+        With a ``memory_budget``, forward projection, ratio and
+        back-projection run chunk by chunk, so that nothing of the size of
+        the events is held in memory and ``data`` and ``background`` can be
+        memory-mapped. See `em_backprojection` for the parameters.
+        """
+        if self.memory_budget is None:
+            # The reference file written at creation is projected as is
+            return _plain_em_backprojection(self, volume, data, background,
+                                            monitor)
+
+        _write_fortran(self.volume_file, volume)
+
+        def ratio(start, stop):
+            _write_events(self.reference_sinogram_file, self._buffer,
+                          self.geometry, start, stop)
+            self._project()
+            output = np.memmap(self.sinogram_file.name, dtype='float32',
+                               mode='r', shape=(stop - start, 7))
+            proj = np.array(output[:, 6])
+            del output
+            if background is not None:
+                proj += background[start:stop]
+            values = np.asarray(data[start:stop], dtype='float32')
+            if monitor is not None:
+                monitor.add_projection(proj, values)
+            return values / np.maximum(proj, _EPS)
+
+        return self._backproject_chunks(ratio)
+
+    def sensitivity_image(self):
+        """Return ``A^* 1``, clipped to positive, chunk by chunk."""
+        return np.maximum(self._backproject_chunks(lambda start, stop: 1),
+                          _EPS)
+
+    def extended(self, geometry):
+        """Return the projector of the events of ``geometry``.
+
+        ``geometry`` holds the events of this operator followed by new
+        ones, e.g. a memory-mapped store that was appended to. Without a
+        ``memory_budget``, only the new events are written to the reference
+        file. The returned operator takes over the scratch files, this one
+        must not be used anymore.
+        """
+        nevents = self.range.size
+        if len(geometry) < nevents:
+            raise ValueError('`geometry` has {} events, expected at least {}'
+                             ''.format(len(geometry), nevents))
+        op = copy.copy(self)
+        odl.Operator.__init__(op, self.domain, listmode_space(len(geometry)),
+                              linear=True)
+        op.geometry = geometry
+        op.chunk_size = _chunk_size(self.memory_budget, len(geometry),
+                                    self.domain.size)
+        if op.chunk_size != self.chunk_size:
+            op._buffer = None
+        if self.memory_budget is None:
+            op.reference_sinogram_file.seek(4 * 7 * nevents)
+            op.reference_sinogram_file.write(
+                _events(geometry[nevents:]).data)
+            op.reference_sinogram_file.flush()
+            op.sinogram_file.resize(4 * 7 * op.chunk_size)
+        return op
+
+    def _call(self, volume):
+        # Copy volume to disk
+        _write_fortran(self.volume_file, volume)
+
+        if self.chunk_size == self.range.size:
+            self._project()
+            sinogram = np.fromfile(self.sinogram_file.name, dtype='float32')
+            sinogram = sinogram.reshape([self.range.size, 7], order='C')
+            return sinogram[:, -1]
+
+        if self._buffer is None:
+            self._buffer = np.empty((self.chunk_size, 7), dtype='float32')
+        result = np.empty(self.range.size, dtype='float32')
+        for start in range(0, self.range.size, self.chunk_size):
+            stop = min(start + self.chunk_size, self.range.size)
+            _write_events(self.reference_sinogram_file, self._buffer,
+                          self.geometry, start, stop)
+            self._project()
+            # Read only the values, not the whole output
+            output = np.memmap(self.sinogram_file.name, dtype='float32',
+                               mode='r', shape=(stop - start, 7))
+            result[start:stop] = output[:, 6]
+            del output
+        return result
 
     @property
     def adjoint(self):
         return EMReconBackProjectorList(
             self.range, self.domain,
             geometry=self.geometry,
-            settings=self.settings)
+            settings=self.settings,
+            memory_budget=self.memory_budget)
 
 
 class EMReconBackProjectorList(odl.Operator):
-    def __init__(self, domain, range, geometry, settings):
+    def __init__(self, domain, range, geometry, settings, memory_budget=None):
+        """Initialize a new instance.
+
+        With a ``memory_budget`` in bytes, the events are back-projected in
+        chunks and the partial results accumulated.
+        """
         settings.update(settings_from_domain(range))
         settings_file_name = make_settings_file(settings)
 
         self.geometry = geometry
         self.settings_file_name = settings_file_name
         self.settings = settings
-        self.sinogram_file = tempfile.NamedTemporaryFile(mode='w+')
-        self.backproj_file = tempfile.NamedTemporaryFile(mode='r')
+        self.memory_budget = memory_budget
+        self.chunk_size = _chunk_size(memory_budget, domain.size, range.size)
+        scratch = default_scratch()
+        self.sinogram_file = scratch.file(4 * 7 * self.chunk_size)
+        self.backproj_file = scratch.file(4 * range.size)
+        self._events = None
         odl.Operator.__init__(self, domain, range, linear=True)
 
+    def _backproject(self):
+        """Return the back-projection of the current event file."""
+        _run_emrecon('EMrecon_artificial_tools', 4,
+                     self.settings_file_name,
+                     self.sinogram_file.name,
+                     self.backproj_file.name)
+        return _read_fortran(self.backproj_file.name, self.range.shape)
+
     def _call(self, sinogram):
-        npsinogram = np.asarray(sinogram, dtype='float32')
-        sinogram_with_geom = np.hstack((self.geometry, npsinogram[:, None]))
-        fortransinogram = np.asfortranarray(sinogram_with_geom,
-                                            dtype='float32')
-        # fortransinogram = fortransinogram.swapaxes(0, 2)
-        self.sinogram_file.seek(0)
-        self.sinogram_file.write(fortransinogram.tobytes())
-        self.sinogram_file.flush()
-
-        command = 'echo "4" | EMrecon_artificial_tools {} {} {} > /dev/null'.format(
-            self.settings_file_name,
-            self.sinogram_file.name,
-            self.backproj_file.name)
-        os.system(command)
-
-        backproj = np.fromfile(self.backproj_file.name, dtype='float32')
-        backproj = backproj.reshape(self.range.shape, order='F')
+        if self.chunk_size == self.domain.size:
+            # The geometry part is filled once and reused between calls
+            if self._events is None:
+                self._events = _events(self.geometry)
+            self._events[:, 6] = sinogram
+            self.sinogram_file.seek(0)
+            self.sinogram_file.write(self._events.data)
+            self.sinogram_file.flush()
+            backproj = self._backproject()
+        else:
+            if self._events is None:
+                self._events = np.empty((self.chunk_size, 7), dtype='float32')
+            sinogram = np.asarray(sinogram)
+            backproj = None
+            for start in range(0, self.domain.size, self.chunk_size):
+                stop = min(start + self.chunk_size, self.domain.size)
+                _write_events(self.sinogram_file, self._events,
+                              self.geometry, start, stop,
+                              sinogram[start:stop])
+                if backproj is None:
+                    backproj = self._backproject()
+                else:
+                    backproj += self._backproject()
 
         # Scale the adjoint properly
         backproj /= self.range.cell_volume
@@ -205,7 +409,8 @@ class EMReconBackProjectorList(odl.Operator):
         return EMReconForwardProjectorList(
             self.range, self.domain,
             geometry=self.geometry,
-            settings=self.settings)
+            settings=self.settings,
+            memory_budget=self.memory_budget)
 
 
 class EMReconAttenuationCorrection(odl.Operator):
@@ -223,28 +428,23 @@ class EMReconAttenuationCorrection(odl.Operator):
             settings_file_name = make_settings_file(settings)
 
         self.settings_file_name = settings_file_name
-        self.sinogram_in = tempfile.NamedTemporaryFile(mode='w+', delete=False)
-        self.sinogram_out = tempfile.NamedTemporaryFile(mode='r', delete=False)
+        scratch = default_scratch()
+        self.sinogram_in = scratch.file(4 * sinogram_space.size)
+        self.sinogram_out = scratch.file(4 * sinogram_space.size)
         odl.Operator.__init__(self, domain=sinogram_space,
                               range=sinogram_space, linear=True)
 
     def _call(self, volume):
         # Copy volume to disk
-        fortranvolume = np.asfortranarray(volume, dtype='float32')
-        fortranvolume = fortranvolume.swapaxes(0, 2)
-        self.sinogram_in.seek(0)
-        self.sinogram_in.write(fortranvolume.tobytes())
-        self.sinogram_in.flush()
-
-        command = 'echo "3" | EMrecon_siemens_pet_tools {} {} {} {} > /dev/null'.format(
-            self.settings_file_name,
-            self.umapfile,
-            self.sinogram_in.name,
-            self.sinogram_out.name)
-        os.system(command)
-
-        sinogram = np.fromfile(self.sinogram_out.name, dtype='float32')
-        sinogram = sinogram.reshape(self.range.shape, order='F')
+        _write_fortran(self.sinogram_in, volume)
+
+        _run_emrecon('EMrecon_siemens_pet_tools', 3,
+                     self.settings_file_name,
+                     self.umapfile,
+                     self.sinogram_in.name,
+                     self.sinogram_out.name)
+
+        sinogram = _read_fortran(self.sinogram_out.name, self.range.shape)
 
         return sinogram
 
@@ -262,34 +462,26 @@ class EMReconScatteringSimulation(odl.Operator):
             self.umap_file_name = settings['UMAPFILENAME']
 
         self.settings_file_name = settings_file_name
-        self.volume_file = tempfile.NamedTemporaryFile(mode='w+')
-        self.scatter_file = tempfile.NamedTemporaryFile(mode='r')
-        self.sinogram_in = tempfile.NamedTemporaryFile(mode='w+', delete=False)
-        fortransino = np.asfortranarray(sinogram, dtype='float32')
-        fortransino = fortransino.swapaxes(0, 2)
-        self.sinogram_in.seek(0)
-        self.sinogram_in.write(fortransino.tobytes())
-        self.sinogram_in.flush()
+        scratch = default_scratch()
+        self.volume_file = scratch.file(4 * domain.size)
+        self.scatter_file = scratch.file(4 * range.size)
+        self.sinogram_in = scratch.file(4 * range.size)
+        _write_fortran(self.sinogram_in, sinogram)
         odl.Operator.__init__(self, domain, range, linear=False)
 
     def _call(self, volume):
         # Copy volume to disk
-        fortranvolume = np.asfortranarray(volume, dtype='float32')
-        fortranvolume = fortranvolume.swapaxes(0, 2)
-        self.volume_file.seek(0)
-        self.volume_file.write(fortranvolume.tobytes())
-        self.volume_file.flush()
-
-        command = 'echo "7" | EMrecon_siemens_pet_tools {} {} {} {} -1 {} > /dev/null'.format(
-            self.settings_file_name,
-            self.volume_file.name,
-            self.umap_file_name,
-            self.sinogram_in.name,
-            self.scatter_file.name)
-        os.system(command)
-
-        scatter = np.fromfile(self.scatter_file.name, dtype='float32')
-        scatter = scatter.reshape(self.range.shape, order='F')
+        _write_fortran(self.volume_file, volume)
+
+        _run_emrecon('EMrecon_siemens_pet_tools', 7,
+                     self.settings_file_name,
+                     self.volume_file.name,
+                     self.umap_file_name,
+                     self.sinogram_in.name,
+                     -1,
+                     self.scatter_file.name)
+
+        scatter = _read_fortran(self.scatter_file.name, self.range.shape)
 
         return scatter
 
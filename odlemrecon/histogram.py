@@ -0,0 +1,267 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Histogramming of list-mode events by detector pair.
+
+The detector points of GATE events are assigned to the crystals of a
+cylindrical scanner. Events of the same detector pair are then counted
+with `numpy.bincount`, either into a sinogram or into one weighted
+list-mode event per detector pair that was hit. The weighted events give
+the same EM update as the raw events with at most as many LORs, since
+list-mode EM sums over events and identical LORs can be grouped.
+
+Both are projected with `EMReconForwardProjectorList`, whose cost grows
+with the number of events, so `prepare_data` only deduplicates the LORs:
+it returns the histogrammed events whenever a detector pair was hit more
+than once. The sinogram of `histogram_sinogram` has a layout of its own,
+not that of the EMrecon sinogram projector, e.g. for inspecting the data,
+and is therefore not offered as a representation.
+"""
+
+import numpy as np
+
+__all__ = ('CylindricalScanner', 'histogram_events', 'histogram_sinogram',
+           'select_representation', 'prepare_data')
+
+
+class CylindricalScanner(object):
+
+    """Rings of equally spaced crystals on a cylinder around the z axis."""
+
+    def __init__(self, radius, ncrystals, nrings, ring_pitch, z_center=0.0):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        radius : positive `float`
+            Radius of the crystal faces in mm.
+        ncrystals : positive even `int`
+            Number of crystals per ring, crystal 0 lies on the x axis.
+        nrings : positive `int`
+            Number of rings.
+        ring_pitch : positive `float`
+            Axial distance of the rings in mm.
+        z_center : `float`, optional
+            Axial position of the center of the rings in mm.
+        """
+        if ncrystals % 2:
+            raise ValueError('`ncrystals` must be even, got {}'
+                             ''.format(ncrystals))
+        self.radius = float(radius)
+        self.ncrystals = int(ncrystals)
+        self.nrings = int(nrings)
+        self.ring_pitch = float(ring_pitch)
+        self.z_center = float(z_center)
+
+    @property
+    def ndetectors(self):
+        return self.ncrystals * self.nrings
+
+    @property
+    def sinogram_shape(self):
+        """Shape ``(radial, view, ring pair)`` of the sinogram."""
+        return (self.ncrystals - 1, self.ncrystals // 2, self.nrings ** 2)
+
+    def detector_indices(self, points):
+        """Return the index of the crystal nearest to each point.
+
+        Parameters
+        ----------
+        points : `array-like`, shape ``(n, 3)``
+            Detector points, e.g. ``geometry[:, :3]`` of list-mode events.
+        """
+        points = np.asarray(points)
+        angle = np.arctan2(points[:, 1], points[:, 0])
+        crystal = np.round(angle * (self.ncrystals / (2 * np.pi))).astype(
+            'int64') % self.ncrystals
+        z_first = self.z_center - 0.5 * (self.nrings - 1) * self.ring_pitch
+        ring = np.round((points[:, 2] - z_first) / self.ring_pitch)
+        ring = np.clip(ring, 0, self.nrings - 1).astype('int64')
+        return ring * self.ncrystals + crystal
+
+    def detector_positions(self, indices):
+        """Return the ``(n, 3)`` centers of the crystal faces."""
+        indices = np.asarray(indices)
+        ring, crystal = np.divmod(indices, self.ncrystals)
+        angle = crystal * (2 * np.pi / self.ncrystals)
+        z_first = self.z_center - 0.5 * (self.nrings - 1) * self.ring_pitch
+        return np.stack([self.radius * np.cos(angle),
+                         self.radius * np.sin(angle),
+                         z_first + ring * self.ring_pitch], axis=1)
+
+    def pair_indices(self, geometry):
+        """Return an index per event that identifies its detector pair.
+
+        The index does not depend on the order of the two detector points.
+        """
+        geometry = np.asarray(geometry)
+        first = self.detector_indices(geometry[:, :3])
+        second = self.detector_indices(geometry[:, 3:6])
+        low = np.minimum(first, second)
+        high = np.maximum(first, second)
+        return low * self.ndetectors + high
+
+    def sinogram_indices(self, pairs):
+        """Return the flat (Fortran order) sinogram bin of detector pairs.
+
+        For crystals ``a < b`` in ring order, the LOR has the normal angle
+        ``pi * (a + b) / ncrystals`` and the signed distance
+        ``radius * cos(pi * (b - a) / ncrystals)`` from the axis. The view
+        is the normal angle folded to ``[0, pi)`` in steps of
+        ``2 pi / ncrystals``, the radial bin the signed distance, flipped
+        with the folding. Every detector pair thus has a bin of its own.
+        Pairs of crystals at the same angle have no transaxial extent and
+        get the index -1.
+
+        Examples
+        --------
+        >>> scanner = CylindricalScanner(100.0, 8, 2, 4.0)
+        >>> first, second = np.triu_indices(scanner.ndetectors, 1)
+        >>> bins = scanner.sinogram_indices(first * scanner.ndetectors +
+        ...                                 second)
+        >>> valid = bins[bins >= 0]
+        >>> bool(len(np.unique(valid)) == len(valid) ==
+        ...      np.prod(scanner.sinogram_shape))
+        True
+        """
+        first, second = np.divmod(np.asarray(pairs), self.ndetectors)
+        ring1, a = np.divmod(first, self.ncrystals)
+        ring2, b = np.divmod(second, self.ncrystals)
+        # Order each pair by crystal, the rings move along
+        swap = a > b
+        a, b = np.where(swap, b, a), np.where(swap, a, b)
+        ring1, ring2 = (np.where(swap, ring2, ring1),
+                        np.where(swap, ring1, ring2))
+
+        total = a + b
+        distance = b - a
+        # Normal angles beyond pi are folded back, which flips the sign of
+        # the distance
+        folded = total >= self.ncrystals
+        radial = np.where(folded, self.ncrystals - distance, distance) - 1
+        view = (total % self.ncrystals) // 2
+        plane = ring1 * self.nrings + ring2
+        nradial, nview, _ = self.sinogram_shape
+        index = radial + nradial * (view + nview * plane)
+        return np.where(distance > 0, index, -1)
+
+
+def histogram_events(events, scanner):
+    """Combine the events of each detector pair into one weighted event.
+
+    Parameters
+    ----------
+    events : `array-like`, shape ``(n, 7)``
+        List-mode events ``[px_1, py_1, pz_1, px_2, py_2, pz_2, val]``.
+    scanner : `CylindricalScanner`
+        Scanner the events were acquired with.
+
+    Returns
+    -------
+    histogram : `numpy.ndarray`, shape ``(m, 7)``
+        One float32 event per detector pair that was hit, between the
+        crystal centers, with the summed values of its events.
+    """
+    events = np.asarray(events, dtype='float32').reshape([-1, 7])
+    pairs, inverse = np.unique(scanner.pair_indices(events[:, :6]),
+                               return_inverse=True)
+    counts = np.bincount(inverse, weights=events[:, 6])
+
+    first, second = np.divmod(pairs, scanner.ndetectors)
+    histogram = np.empty((len(pairs), 7), dtype='float32')
+    histogram[:, :3] = scanner.detector_positions(first)
+    histogram[:, 3:6] = scanner.detector_positions(second)
+    histogram[:, 6] = counts
+    return histogram
+
+
+def histogram_sinogram(events, scanner):
+    """Histogram list-mode events into the sinogram of ``scanner``.
+
+    The sinogram has shape `CylindricalScanner.sinogram_shape`, with the
+    bins of `CylindricalScanner.sinogram_indices`. This is not the layout of
+    EMrecon sinograms. Events between crystals at the same angle are left
+    out.
+
+    Parameters
+    ----------
+    events : `array-like`, shape ``(n, 7)``
+        List-mode events ``[px_1, py_1, pz_1, px_2, py_2, pz_2, val]``.
+    scanner : `CylindricalScanner`
+        Scanner the events were acquired with.
+
+    Returns
+    -------
+    sinogram : `numpy.ndarray`
+        Float32 sinogram, Fortran ordered like EMrecon sinograms.
+    """
+    events = np.asarray(events, dtype='float32').reshape([-1, 7])
+    bins = scanner.sinogram_indices(scanner.pair_indices(events[:, :6]))
+    valid = bins >= 0
+    shape = scanner.sinogram_shape
+    counts = np.bincount(bins[valid], weights=events[valid, 6],
+                         minlength=int(np.prod(shape)))
+    return counts.astype('float32').reshape(shape, order='F')
+
+
+def select_representation(nevents, nlors):
+    """Return whether to project the raw or the deduplicated events.
+
+    Both are list-mode events with the same cost per event, so the
+    histogram is used if it has fewer events, i.e. if some detector pair
+    was hit more than once.
+
+    Parameters
+    ----------
+    nevents : `int`
+        Number of list-mode events.
+    nlors : `int`
+        Number of distinct detector pairs among the events.
+
+    Returns
+    -------
+    representation : {'listmode', 'histogram'}
+    """
+    # Prefer the raw events on ties, they keep the measured positions
+    if nlors < nevents:
+        return 'histogram'
+    return 'listmode'
+
+
+def prepare_data(events, scanner):
+    """Deduplicate the LORs of list-mode events if that saves events.
+
+    Parameters
+    ----------
+    events : `array-like`, shape ``(n, 7)``
+        List-mode events ``[px_1, py_1, pz_1, px_2, py_2, pz_2, val]``.
+    scanner : `CylindricalScanner`
+        Scanner the events were acquired with.
+
+    Returns
+    -------
+    representation : {'listmode', 'histogram'}
+    data : `numpy.ndarray`
+        ``n x 7`` raw or ``m x 7`` histogrammed events, to be projected
+        with `EMReconForwardProjectorList`.
+    """
+    events = np.asarray(events, dtype='float32').reshape([-1, 7])
+    histogram = histogram_events(events, scanner)
+    representation = select_representation(len(events), len(histogram))
+    if representation == 'listmode':
+        return representation, events
+    return representation, histogram
@@ -0,0 +1,198 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Execution of the EMrecon command line tools.
+
+The tools are started directly, without a shell, and get the number of
+the menu entry on stdin. A run that fails or exceeds its timeout is
+retried a bounded number of times and then raises `EMReconError`, so that
+a stale output file is never read as result.
+
+Every run waits for a process slot of the `default_scheduler`, which also
+sets its number of threads.
+
+The default launcher is configured with ``$ODLEMRECON_TIMEOUT`` (seconds)
+and ``$ODLEMRECON_RETRIES`` if these are set.
+"""
+
+import os
+import subprocess
+import threading
+import time
+
+from odlemrecon.scheduler import default_scheduler
+
+__all__ = ('EMReconError', 'Launcher', 'default_launcher',
+           'set_default_launcher')
+
+
+class EMReconError(RuntimeError):
+
+    """Raised when an EMrecon tool fails."""
+
+    def __init__(self, message, returncode=None, stderr=''):
+        RuntimeError.__init__(self, message)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class Launcher(object):
+
+    """Runs EMrecon tools and keeps statistics of the runs."""
+
+    def __init__(self, timeout=None, retries=1):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        timeout : positive `float`, optional
+            Seconds after which a run is killed. Default: no limit.
+        retries : nonnegative `int`, optional
+            Number of times a failed or timed out run is repeated before
+            `EMReconError` is raised.
+        """
+        self.timeout = timeout
+        self.retries = int(retries)
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Set all statistics to zero."""
+        with self._lock:
+            self._stats = {'calls': 0, 'runs': 0, 'failures': 0,
+                           'timeouts': 0, 'launch_time': 0.0,
+                           'run_time': 0.0, 'max_launch_time': 0.0}
+
+    @property
+    def stats(self):
+        """Statistics of the runs so far.
+
+        A `dict` with the number of ``calls`` and of process ``runs``
+        (including retries), ``failures`` and ``timeouts``, and the total
+        ``launch_time`` (until the process has started), total
+        ``run_time`` and ``max_launch_time`` in seconds.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _record(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                if key.startswith('max_'):
+                    self._stats[key] = max(self._stats[key], value)
+                else:
+                    self._stats[key] += value
+
+    def _run_once(self, argv, option, env=None):
+        """Run the tool once, return its exit code and stderr."""
+        start = time.time()
+        with open(os.devnull, 'wb') as devnull:
+            try:
+                process = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                           stdout=devnull,
+                                           stderr=subprocess.PIPE, env=env)
+            except OSError as exc:
+                raise EMReconError('cannot start `{}`: {}'
+                                   ''.format(argv[0], exc))
+            launch_time = time.time() - start
+
+            timed_out = []
+            if self.timeout is not None:
+                def kill():
+                    timed_out.append(True)
+                    process.kill()
+
+                timer = threading.Timer(self.timeout, kill)
+                timer.start()
+            try:
+                _, stderr = process.communicate(
+                    '{}\n'.format(option).encode('ascii'))
+            finally:
+                if self.timeout is not None:
+                    timer.cancel()
+
+        self._record(runs=1, launch_time=launch_time,
+                     max_launch_time=launch_time,
+                     run_time=time.time() - start,
+                     timeouts=len(timed_out))
+        return process.returncode, bool(timed_out), stderr
+
+    def run(self, tool, option, *args):
+        """Run ``tool``, selecting ``option`` in its menu.
+
+        Parameters
+        ----------
+        tool : `str`
+            Name of the EMrecon executable, e.g.
+            ``'EMrecon_siemens_pet_tools'``.
+        option : `int`
+            Menu entry, written to the standard input of the tool.
+        args
+            Command line arguments, typically file names.
+
+        Raises
+        ------
+        EMReconError
+            If the tool cannot be started, or all attempts exit with a
+            nonzero code or time out.
+        """
+        argv = [tool] + [str(arg) for arg in args]
+        self._record(calls=1)
+        for attempt in range(self.retries + 1):
+            with default_scheduler().slot() as env:
+                returncode, timed_out, stderr = self._run_once(argv, option,
+                                                               env)
+            if returncode == 0 and not timed_out:
+                return
+
+        self._record(failures=1)
+        stderr = stderr.decode('utf-8', 'replace').strip()
+        if timed_out:
+            reason = 'timed out after {} s'.format(self.timeout)
+        else:
+            reason = 'exited with code {}'.format(returncode)
+        raise EMReconError('`{}` with option {} {} ({} attempts){}'
+                           ''.format(' '.join(argv), option, reason,
+                                     self.retries + 1,
+                                     ':\n' + stderr[-2000:] if stderr else ''),
+                           returncode, stderr)
+
+
+_DEFAULT = [None]
+
+
+def default_launcher():
+    """Return the launcher used by the operators."""
+    if _DEFAULT[0] is None:
+        timeout = os.environ.get('ODLEMRECON_TIMEOUT')
+        _DEFAULT[0] = Launcher(
+            timeout=float(timeout) if timeout else None,
+            retries=int(os.environ.get('ODLEMRECON_RETRIES', 1)))
+    return _DEFAULT[0]
+
+
+def set_default_launcher(launcher):
+    """Set the launcher used by the operators.
+
+    Returns
+    -------
+    previous : `Launcher`
+        The launcher that was used before.
+    """
+    previous = _DEFAULT[0]
+    _DEFAULT[0] = launcher
+    return previous
@@ -0,0 +1,226 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Sorting and subset partitioning of list-mode events.
+
+Events are described by the ``n x 6`` geometry
+``[px_1, py_1, pz_1, px_2, py_2, pz_2]`` of their lines of response (LORs).
+Each LOR is characterized by its transaxial angle, its signed transaxial
+distance from the scanner axis and the axial position of its midpoint, the
+list-mode counterparts of the view, radial bin and plane of a sinogram.
+"""
+
+import numpy as np
+
+from odlemrecon.scratch import default_scratch
+
+__all__ = ('memmap_events', 'lor_coordinates', 'sort_events',
+           'balanced_subsets', 'partition_events')
+
+
+def memmap_events(file_name):
+    """Memory-map the ``n x 7`` float32 events of a .l file.
+
+    Slices such as ``events[start:stop, :6]`` can be passed as geometry to
+    list-mode projectors with a ``memory_budget`` without loading the file.
+    """
+    return np.memmap(file_name, dtype='float32', mode='r').reshape([-1, 7])
+
+
+def lor_coordinates(geometry):
+    """Return the sinogram-like coordinates of list-mode LORs.
+
+    Parameters
+    ----------
+    geometry : `array-like`, shape ``(n, 6)``
+        Detector points of the events.
+
+    Returns
+    -------
+    phi : `numpy.ndarray`
+        Transaxial angle of each LOR in ``[0, pi)``.
+    s : `numpy.ndarray`
+        Signed transaxial distance of each LOR from the scanner axis.
+    z : `numpy.ndarray`
+        Axial position of the midpoint of each LOR.
+    """
+    geometry = np.asarray(geometry)
+    dx = geometry[:, 3] - geometry[:, 0]
+    dy = geometry[:, 4] - geometry[:, 1]
+    phi = np.arctan2(dy, dx) % np.pi
+    # Projection of the first point onto the normal of the LOR
+    s = geometry[:, 1] * np.cos(phi) - geometry[:, 0] * np.sin(phi)
+    z = 0.5 * (geometry[:, 2] + geometry[:, 5])
+    return phi, s, z
+
+
+def sort_events(geometry, nangles=64):
+    """Return the permutation sorting events by LOR direction and position.
+
+    Events are grouped into ``nangles`` transaxial angle bins, ordered by
+    axial midpoint and then by transaxial distance within each bin, so that
+    consecutive events traverse nearby voxels.
+
+    Parameters
+    ----------
+    geometry : `array-like`, shape ``(n, 6)``
+        Detector points of the events.
+    nangles : positive `int`, optional
+        Number of angle bins.
+
+    Returns
+    -------
+    order : `numpy.ndarray`
+        Indices of the events in sorted order.
+    """
+    phi, s, z = lor_coordinates(geometry)
+    angle_bin = np.minimum((phi * (nangles / np.pi)).astype(int), nangles - 1)
+    # Last key is the primary one
+    return np.lexsort((s, z, angle_bin))
+
+
+def balanced_subsets(geometry, nsubsets, reorder=True, nangles=64):
+    """Return angularly balanced subsets of equal size.
+
+    Events are ordered by angle and dealt to the subsets in turn, like the
+    interleaved views of sinogram subsets. Every subset thus covers all
+    directions and the subset sizes differ by at most one event.
+
+    Parameters
+    ----------
+    geometry : `array-like`, shape ``(n, 6)``
+        Detector points of the events.
+    nsubsets : positive `int`
+        Number of subsets.
+    reorder : bool, optional
+        If ``True``, the events of each subset are ordered with
+        `sort_events` for memory locality in the projector. Otherwise they
+        are ordered by angle only.
+    nangles : positive `int`, optional
+        Number of angle bins used for reordering.
+
+    Returns
+    -------
+    subsets : `list` of `numpy.ndarray`
+        Event indices of each subset.
+    """
+    geometry = np.asarray(geometry)
+    if nsubsets < 1 or nsubsets > len(geometry):
+        raise ValueError('`nsubsets` must be between 1 and the number of '
+                         'events {}, got {}'.format(len(geometry), nsubsets))
+    phi = lor_coordinates(geometry)[0]
+    by_angle = np.argsort(phi, kind='mergesort')
+
+    subsets = []
+    for i in range(nsubsets):
+        indices = by_angle[i::nsubsets]
+        if reorder:
+            indices = indices[sort_events(geometry[indices], nangles)]
+        subsets.append(indices)
+    return subsets
+
+
+# Bytes per event held in memory while partitioning a chunk: the events,
+# their LOR coordinates and the sorting indices
+_PARTITION_BYTES = 4 * 7 + 8 * 3 + 8 * 2
+
+
+def _partition_chunked(events, nsubsets, reorder, nangles, chunk_size):
+    """Write balanced subsets to a scratch file, a chunk at a time.
+
+    The events of each chunk are ordered by angle and dealt to the subsets,
+    continuing the turns of the previous chunks, so that the subset sizes
+    are those of `balanced_subsets`.
+    """
+    nevents = len(events)
+    sizes = [len(range(i, nevents, nsubsets)) for i in range(nsubsets)]
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype('int64')
+
+    scratch_file = default_scratch().file(4 * 7 * nevents)
+    store = np.memmap(scratch_file.name, dtype='float32', mode='r+',
+                      shape=(nevents, 7))
+    # The file is kept while views of the store exist
+    store.scratch_file = scratch_file
+
+    cursors = offsets[:-1].copy()
+    for start in range(0, nevents, chunk_size):
+        chunk = np.array(events[start:start + chunk_size], dtype='float32')
+        by_angle = np.argsort(lor_coordinates(chunk[:, :6])[0],
+                              kind='mergesort')
+        for i in range(nsubsets):
+            indices = by_angle[(i - start) % nsubsets::nsubsets]
+            if reorder:
+                indices = indices[sort_events(chunk[indices, :6], nangles)]
+            store[cursors[i]:cursors[i] + len(indices)] = chunk[indices]
+            cursors[i] += len(indices)
+    store.flush()
+
+    return ([store[offsets[i]:offsets[i + 1], :6] for i in range(nsubsets)],
+            [store[offsets[i]:offsets[i + 1], 6] for i in range(nsubsets)])
+
+
+def partition_events(events, nsubsets, reorder=True, nangles=64,
+                     balanced=True, memory_budget=None):
+    """Split list-mode events into balanced subsets.
+
+    Parameters
+    ----------
+    events : `array-like`, shape ``(n, 7)``
+        Events ``[px_1, py_1, pz_1, px_2, py_2, pz_2, val]``, e.g. memory
+        mapped from a .l file.
+    nsubsets : positive `int`
+        Number of subsets.
+    reorder, nangles : optional
+        See `balanced_subsets`.
+    balanced : bool, optional
+        If ``False``, subset ``i`` consists of every ``nsubsets``-th event
+        starting at ``i``. The subsets are then views of ``events`` instead
+        of copies.
+    memory_budget : positive `int`, optional
+        Bytes held in memory while partitioning, e.g. for acquisitions too
+        large for memory. The balanced subsets are then written to scratch
+        space and returned memory-mapped. Events are dealt to the subsets
+        by angle within chunks that fit the budget, and reordered within
+        those chunks.
+
+    Returns
+    -------
+    geometry : `list` of `numpy.ndarray`
+        ``m x 6`` geometry of each subset, float32, to be passed to
+        `EMReconForwardProjectorList`.
+    values : `list` of `numpy.ndarray`
+        Values of the events of each subset.
+    """
+    events = np.asarray(events, dtype='float32').reshape([-1, 7])
+    if not balanced:
+        return ([events[i::nsubsets, :6] for i in range(nsubsets)],
+                [events[i::nsubsets, 6] for i in range(nsubsets)])
+
+    if memory_budget is not None:
+        if nsubsets < 1 or nsubsets > len(events):
+            raise ValueError('`nsubsets` must be between 1 and the number of '
+                             'events {}, got {}'.format(len(events),
+                                                        nsubsets))
+        chunk_size = max(nsubsets, int(memory_budget) // _PARTITION_BYTES)
+        return _partition_chunked(events, nsubsets, reorder, nangles,
+                                  chunk_size)
+
+    subsets = balanced_subsets(events[:, :6], nsubsets, reorder=reorder,
+                               nangles=nangles)
+    geometry = [events[indices, :6] for indices in subsets]
+    values = [events[indices, 6] for indices in subsets]
+    return geometry, values
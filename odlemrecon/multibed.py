@@ -0,0 +1,240 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Whole-body reconstruction from several bed positions.
+
+Each bed is reconstructed in its own volume, translated axially to the bed
+position so that EMrecon gets the matching ``OFFSET_Z`` through
+`settings_from_domain`. Event coordinates and sinograms must therefore be
+given in the common patient frame. The bed volumes are reconstructed
+concurrently on a process pool and blended into one volume.
+"""
+
+import multiprocessing
+
+import numpy as np
+import odl
+
+from odlemrecon.convergence import monitored_mlem
+from odlemrecon.emreconoperators import (EMReconForwardProjector,
+                                         EMReconForwardProjectorList)
+from odlemrecon.listmode import partition_events
+from odlemrecon.pipeline import pipelined_osmlem
+from odlemrecon.scheduler import share_cores
+from odlemrecon.util import volume_space, sinogram_space, listmode_space
+
+__all__ = ('bed_space', 'stitch_beds', 'multibed_reconstruction')
+
+
+def bed_space(fov, shape, z_center, dtype='float32'):
+    """Create the volume space of a bed position.
+
+    Parameters
+    ----------
+    fov : `array-like`
+        Size of the field of view of one bed in mm.
+    shape : `sequence` of `int`
+        Number of voxels per axis.
+    z_center : `float`
+        Axial position of the center of the bed field of view in mm.
+    dtype : optional
+        Data type of the space.
+    """
+    space = volume_space(fov, shape, dtype=dtype)
+    shift = np.array([0, 0, z_center], dtype=float)
+    return odl.uniform_discr(space.min_pt + shift, space.max_pt + shift,
+                             space.shape, dtype=space.dtype)
+
+
+def _axial_weights(space):
+    """Weights decreasing linearly towards both axial ends of a bed."""
+    nz = space.shape[2]
+    center = np.arange(nz) + 0.5
+    return np.minimum(center, nz - center)
+
+
+def stitch_beds(volumes, weights=None):
+    """Blend bed volumes into one whole-body volume.
+
+    Overlapping slices are averaged with the given weights, so every slice
+    covered by a single bed is taken from that bed unchanged.
+
+    Parameters
+    ----------
+    volumes : sequence of `DiscreteLpElement`
+        Bed volumes, e.g. in spaces from `bed_space`. All must have the same
+        transaxial geometry and axial voxel size, with axial offsets that
+        differ by whole voxels.
+    weights : sequence of `array-like`, optional
+        Weight per bed, broadcastable to the bed volume, e.g. the axial
+        sensitivity profile. Default: linear ramps towards the axial ends
+        of each bed.
+
+    Returns
+    -------
+    volume : `DiscreteLpElement`
+        The whole-body volume, spanning all beds.
+    """
+    spaces = [vol.space for vol in volumes]
+    first = spaces[0]
+    dz = first.cell_sides[2]
+    for space in spaces[1:]:
+        if (space.shape[:2] != first.shape[:2] or
+                not np.allclose(space.min_pt[:2], first.min_pt[:2]) or
+                not np.allclose(space.max_pt[:2], first.max_pt[:2]) or
+                not np.isclose(space.cell_sides[2], dz)):
+            raise ValueError('bed space {!r} does not match {!r}'
+                             ''.format(space, first))
+
+    z_min = min(space.min_pt[2] for space in spaces)
+    z_max = max(space.max_pt[2] for space in spaces)
+    nz = int(round((z_max - z_min) / dz))
+    whole = odl.uniform_discr([first.min_pt[0], first.min_pt[1], z_min],
+                              [first.max_pt[0], first.max_pt[1], z_max],
+                              [first.shape[0], first.shape[1], nz],
+                              dtype=first.dtype)
+
+    total = np.zeros(whole.shape, dtype='float32')
+    weight_sum = np.zeros(nz, dtype='float32')
+    for i, vol in enumerate(volumes):
+        start = (vol.space.min_pt[2] - z_min) / dz
+        if not np.isclose(start, round(start), atol=1e-3):
+            raise ValueError('bed {} is not aligned with the axial voxel grid'
+                             ''.format(i))
+        axial = slice(int(round(start)), int(round(start)) + vol.shape[2])
+
+        if weights is None:
+            weight = _axial_weights(vol.space)
+        else:
+            weight = np.broadcast_to(weights[i], vol.shape)
+        total[:, :, axial] += weight * np.asarray(vol)
+        if weight.ndim == 1:
+            weight_sum[axial] += weight
+        else:
+            # Voxelwise weights, e.g. sensitivities
+            if weight_sum.ndim == 1:
+                weight_sum = np.broadcast_to(weight_sum, whole.shape).copy()
+            weight_sum[:, :, axial] += weight
+
+    # Slices covered by no bed stay zero
+    total /= np.where(weight_sum > 0, weight_sum, 1)
+    return whole.element(total)
+
+
+def _load_bed(bed, space, settings, subsets):
+    """Return the operator(s) and data of a bed."""
+    settings = dict(settings)
+    if bed.get('mode', 'listmode') == 'sinogram':
+        ran_shape = bed['range_shape']
+        data = bed['data']
+        if isinstance(data, str):
+            data = np.fromfile(data, dtype='float32')
+        data = np.reshape(data, ran_shape, order='F')
+        op = EMReconForwardProjector(space, sinogram_space(ran_shape),
+                                     settings=settings)
+        return op, data
+
+    data = bed['data']
+    if isinstance(data, str):
+        data = np.fromfile(data, dtype='float32')
+    geometry, values = partition_events(data, subsets)
+    op = [EMReconForwardProjectorList(space, listmode_space(len(geom)), geom,
+                                      settings=dict(settings))
+          for geom in geometry]
+    return op, values
+
+
+def _reconstruct_bed(task):
+    """Pool task reconstructing one bed, returns the float32 volume."""
+    bed, fov, shape, settings, niter, subsets = task
+    space = bed_space(fov, shape, bed['z'])
+    op, data = _load_bed(bed, space, settings, subsets)
+
+    x = space.one()
+    if bed.get('mode', 'listmode') == 'sinogram':
+        monitored_mlem(op, x, data, niter,
+                       sensitivities=bed.get('sensitivities'))
+    else:
+        sens = bed.get('sensitivities', 1.0 / subsets)
+        pipelined_osmlem(op, x, data, niter=niter, sensitivities=sens)
+
+    return np.asarray(x, dtype='float32')
+
+
+def multibed_reconstruction(beds, fov, shape, settings=None, niter=10,
+                            subsets=1, nworkers=None, weights=None):
+    """Reconstruct several bed positions and stitch them.
+
+    The beds are reconstructed concurrently, one process per bed, so with
+    at least as many cores as beds the wall-clock time is that of a single
+    bed. The workers share the cores with `share_cores`, which sets the
+    ``OMP_NUM_THREADS`` of their EMrecon runs so that together they do not
+    oversubscribe the cores. An ``OMP_NUM_THREADS`` set by the user is kept
+    unless ``$ODLEMRECON_CORES`` or ``$ODLEMRECON_MAX_PROCESSES`` configure
+    a budget.
+
+    Parameters
+    ----------
+    beds : sequence of `dict`
+        One description per bed with keys
+
+        - ``'z'``: axial center of the bed field of view in mm,
+        - ``'data'``: list-mode ``n x 7`` events, or a sinogram, as array or
+          float32 file name,
+        - ``'mode'`` (optional): ``'listmode'`` (default) or ``'sinogram'``,
+        - ``'range_shape'``: sinogram shape, for sinogram beds,
+        - ``'sensitivities'`` (optional): as in `pipelined_osmlem`, or a
+          sensitivity image for sinogram beds.
+
+    fov : `array-like`
+        Size of the field of view of one bed in mm.
+    shape : `sequence` of `int`
+        Number of voxels per bed.
+    settings : `dict`, optional
+        EMRecon settings shared by all beds, e.g. ``{'SCANNERTYPE': 1}``.
+        The volume settings are added per bed.
+    niter : positive `int`, optional
+        Number of iterations per bed, passes over all subsets for
+        list-mode beds.
+    subsets : positive `int`, optional
+        Number of ordered subsets for list-mode beds.
+    nworkers : positive `int`, optional
+        Number of worker processes. Default: the smaller of the number of
+        beds and of CPUs.
+    weights : sequence of `array-like`, optional
+        Stitching weights, see `stitch_beds`.
+
+    Returns
+    -------
+    volume : `DiscreteLpElement`
+        The whole-body volume.
+    """
+    settings = {} if settings is None else settings
+    if nworkers is None:
+        nworkers = min(len(beds), multiprocessing.cpu_count())
+
+    tasks = [(bed, fov, shape, settings, niter, subsets) for bed in beds]
+    pool = multiprocessing.Pool(nworkers, share_cores, (nworkers,))
+    try:
+        arrays = pool.map(_reconstruct_bed, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    volumes = [bed_space(fov, shape, bed['z']).element(array)
+               for bed, array in zip(beds, arrays)]
+    return stitch_beds(volumes, weights)
@@ -0,0 +1,216 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pipelined execution of list-mode subset projections."""
+
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from odlemrecon.em import _EPS, osem
+from odlemrecon.emreconoperators import _read_fortran, _run_emrecon
+from odlemrecon.scratch import default_scratch
+
+__all__ = ('ListModeSubsetPipeline', 'pipelined_osmlem')
+
+
+class ListModeSubsetPipeline(object):
+
+    """Double-buffered projections over list-mode subsets.
+
+    Back-projection inputs are staged in two alternating scratch files. While
+    EMrecon works on one subset, a background thread writes the events of
+    the next subset into the other file and loads its data, so that only the
+    projected values remain to be written once the subset is due.
+
+    Use `prefetch` to announce the next subset, then `forward` and
+    `backward`, or `em_backprojection`, to project the current one.
+
+    Subsets of projectors with a ``memory_budget`` are not staged as a
+    whole, their EM updates run chunk by chunk in the projector with the
+    data read from ``data``.
+    """
+
+    def __init__(self, ops, data=None):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        ops : sequence of `EMReconForwardProjectorList`
+            One projector per subset, all with the same domain.
+        data : sequence of `array-like`, optional
+            Measured values per subset, e.g. memory-mapped arrays. Loaded
+            alongside the events and returned by `data`.
+        """
+        self.ops = list(ops)
+        if data is not None and len(data) != len(self.ops):
+            raise ValueError('`data` has {} subsets, expected {}'
+                             ''.format(len(data), len(self.ops)))
+        self._data = data
+
+        scratch = default_scratch()
+        self._slot_files = [scratch.file() for _ in range(2)]
+        self._backproj_file = scratch.file(4 * self.ops[0].domain.size)
+        self._next_slot = 0
+        self._staged = {}
+        self._pool = ThreadPool(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop the background thread and release the scratch files."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._staged.clear()
+        for scratch_file in self._slot_files + [self._backproj_file]:
+            scratch_file.release()
+
+    def _stage(self, index, slot):
+        """Write the events of subset ``index`` to the given slot."""
+        if getattr(self.ops[index], 'memory_budget', None) is not None:
+            # Read chunk by chunk by the projector, not loaded here
+            data = None if self._data is None else self._data[index]
+            return slot, None, data
+
+        if self._data is None:
+            data = None
+        else:
+            data = np.array(self._data[index], dtype='float32', copy=True)
+
+        geometry = self.ops[index].geometry
+        slot_file = self._slot_files[slot]
+        slot_file.resize(4 * 7 * len(geometry))
+        events = np.memmap(slot_file.name, dtype='float32', mode='r+',
+                           shape=(len(geometry), 7))
+        events[:, :6] = geometry
+        return slot, events, data
+
+    def prefetch(self, index):
+        """Start staging subset ``index`` in the background.
+
+        At most two subsets can be staged at a time, the one being projected
+        and the next one.
+        """
+        if index in self._staged:
+            return
+        if len(self._staged) == 2:
+            raise RuntimeError('both buffers in use, finish a subset with '
+                               '`backward` before prefetching another')
+
+        slot = self._next_slot
+        self._next_slot = 1 - slot
+        self._staged[index] = self._pool.apply_async(self._stage,
+                                                     (index, slot))
+
+    def _get(self, index):
+        """Wait for subset ``index`` to be staged."""
+        self.prefetch(index)
+        return self._staged[index].get()
+
+    def data(self, index):
+        """Return the measured values of subset ``index``."""
+        return self._get(index)[2]
+
+    def forward(self, index, volume):
+        """Project ``volume`` onto the events of subset ``index``."""
+        return self.ops[index](volume)
+
+    def backward(self, index, values):
+        """Back-project ``values`` along the events of subset ``index``.
+
+        This releases the buffer of the subset.
+        """
+        op = self.ops[index]
+        slot, events, _ = self._get(index)
+        if events is None:
+            del self._staged[index]
+            return np.asarray(op.adjoint(values))
+
+        # The mapping is shared, so EMrecon sees the values without a flush
+        events[:, 6] = values
+        _run_emrecon('EMrecon_artificial_tools', 4,
+                     op.settings_file_name,
+                     self._slot_files[slot].name,
+                     self._backproj_file.name)
+        del self._staged[index]
+
+        backproj = _read_fortran(self._backproj_file.name, op.domain.shape)
+
+        # Scale the adjoint properly
+        backproj /= op.domain.cell_volume
+
+        return backproj
+
+    def em_backprojection(self, index, volume, background=None,
+                          monitor=None):
+        """Return the EM correction of subset ``index``.
+
+        See `em_backprojection`, with the data given to the pipeline. This
+        releases the buffer of the subset.
+        """
+        op = self.ops[index]
+        if getattr(op, 'memory_budget', None) is not None:
+            data = self.data(index)
+            del self._staged[index]
+            return op.em_backprojection(volume, data, background, monitor)
+
+        proj = np.asarray(self.forward(index, volume))
+        if background is not None:
+            proj = proj + np.asarray(background)
+        data = self.data(index)
+        if monitor is not None:
+            monitor.add_projection(proj, data)
+        return self.backward(index, data / np.maximum(proj, _EPS))
+
+
+def pipelined_osmlem(op, x, data, niter, sensitivities=None, callback=None,
+                     checkpointer=None, monitor=None, background=None):
+    """Ordered-subsets MLEM with pipelined list-mode projections.
+
+    Same iteration as `osem`, but the next subset is staged by a
+    `ListModeSubsetPipeline` while EMrecon processes the current one.
+
+    Parameters
+    ----------
+    op : sequence of `EMReconForwardProjectorList`
+        One projector per subset.
+    x : ``op[0].domain`` element
+        Starting point of the iteration, updated in place.
+    data : sequence of `array-like`
+        Measured values per subset.
+    niter : positive `int`
+        Number of passes over all subsets.
+    sensitivities, callback, checkpointer, monitor, background : optional
+        See `osem`.
+
+    Returns
+    -------
+    niter : `int`
+        Number of passes done, including those before a checkpoint.
+    """
+    with ListModeSubsetPipeline(op, data) as pipeline:
+        return osem(op, x, data, niter, sensitivities=sensitivities,
+                    background=background, callback=callback,
+                    monitor=monitor, checkpointer=checkpointer,
+                    pipeline=pipeline)
@@ -0,0 +1,134 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Stochastic primal-dual hybrid gradient (SPDHG) method.
+
+Solves ``min_x f(x) + sum_i g_i(L_i x)`` where the ``L_i`` are e.g. the
+projectors of the data subsets and a gradient for TV regularization. Each
+iteration updates the dual variable of a single randomly chosen ``L_i``,
+so it applies one subset projector and its adjoint instead of the full
+forward model.
+
+Reference: Chambolle, Ehrhardt, Richtarik and Schoenlieb, *Stochastic
+primal-dual hybrid gradient algorithm with arbitrary sampling and imaging
+applications*, SIAM J. Optim. 28(4), 2018.
+"""
+
+import numpy as np
+import odl
+
+__all__ = ('spdhg', 'spdhg_step_sizes')
+
+
+def spdhg_step_sizes(ops, prob=None, gamma=0.99, opnorms=None, maxiter=10):
+    """Return step sizes for which `spdhg` converges.
+
+    These are ``sigma_i = gamma / ||L_i||`` and
+    ``tau = gamma * min_i p_i / ||L_i||``.
+
+    Parameters
+    ----------
+    ops : sequence of `Operator`
+        The linear operators ``L_i``.
+    prob : sequence of `float`, optional
+        Probability of choosing each operator. Default: uniform.
+    gamma : `float` in ``(0, 1)``, optional
+        Safety factor of the step sizes.
+    opnorms : sequence of `float`, optional
+        Norms of the operators. Default: estimated with the power method.
+    maxiter : positive `int`, optional
+        Number of power iterations per estimated norm.
+
+    Returns
+    -------
+    tau : `float`
+        Primal step size.
+    sigma : `list` of `float`
+        Dual step size per operator.
+    """
+    if prob is None:
+        prob = [1.0 / len(ops)] * len(ops)
+    if opnorms is None:
+        opnorms = [odl.power_method_opnorm(op, maxiter=maxiter)
+                   for op in ops]
+    sigma = [gamma / norm for norm in opnorms]
+    tau = gamma * min(p / norm for p, norm in zip(prob, opnorms))
+    return tau, sigma
+
+
+def spdhg(x, prox_f, prox_cc_g, L, tau, sigma, niter, prob=None,
+          random_state=None, callback=None):
+    """Stochastic primal-dual hybrid gradient method.
+
+    Parameters
+    ----------
+    x : ``L[i].domain`` element
+        Starting point of the iteration, updated in place.
+    prox_f : `callable`
+        Function returning the proximal operator of ``f`` for a step size,
+        e.g. ``odl.solvers.proximal_box_constraint(space, 0)``.
+    prox_cc_g : sequence of `callable`
+        Functions returning the proximal operators of the convex
+        conjugates of the ``g_i``, e.g. from the KL divergence to the data
+        of each subset.
+    L : sequence of `Operator`
+        The linear operators ``L_i``.
+    tau : positive `float`
+        Primal step size.
+    sigma : sequence of positive `float`
+        Dual step size per operator, see `spdhg_step_sizes`.
+    niter : nonnegative `int`
+        Number of iterations, each touching one operator.
+    prob : sequence of `float`, optional
+        Probability of choosing each operator. Default: uniform.
+    random_state : `numpy.random.RandomState`, optional
+        Source of the random choices, for reproducible runs.
+    callback : `callable`, optional
+        Called with the current iterate after each iteration.
+    """
+    nops = len(L)
+    if len(prox_cc_g) != nops or len(sigma) != nops:
+        raise ValueError('need one proximal and step size per operator, got '
+                         '{} operators, {} proximals and {} step sizes'
+                         ''.format(nops, len(prox_cc_g), len(sigma)))
+    if prob is None:
+        prob = [1.0 / nops] * nops
+    if random_state is None:
+        random_state = np.random
+
+    prox_primal = prox_f(tau)
+    prox_dual = [prox(sigma_i) for prox, sigma_i in zip(prox_cc_g, sigma)]
+
+    # Dual variables and z = sum_i L_i^* y_i, all starting at zero
+    y = [op.range.zero() for op in L]
+    z = x.space.zero()
+    z_bar = x.space.zero()
+
+    for _ in range(niter):
+        prox_primal(x - tau * z_bar, out=x)
+
+        i = random_state.choice(nops, p=prob)
+        y_new = prox_dual[i](y[i] + sigma[i] * L[i](x))
+        dz = L[i].adjoint(y_new - y[i])
+        y[i] = y_new
+
+        # Extrapolate only the change of the chosen dual variable
+        z += dz
+        z_bar.lincomb(1, z, 1.0 / prob[i], dz)
+
+        if callback is not None:
+            callback(x)
@@ -0,0 +1,191 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Sinogram rebinning for fast preview reconstructions.
+
+Sinograms are rebinned by summing groups of adjacent bins per axis, e.g.
+mashing neighbouring angular views or planes. Counts are preserved, so
+rebinned data keep their Poisson statistics.
+
+EMrecon has no projector for rebinned sinograms, and its sinogram layout
+is fixed by the scanner. `SinogramRebinning` composed with an EMrecon
+projector is thus no rebinned projector model: EMrecon still projects at
+full resolution, and rebinning saves no projector work. It models data
+that are compared on a coarser grid, e.g. a mashed reference. The speed-up
+of `preview_reconstruction` comes from its coarse volume alone.
+"""
+
+import numpy as np
+import odl
+
+from odlemrecon.convergence import monitored_mlem
+from odlemrecon.emreconoperators import EMReconForwardProjector
+from odlemrecon.util import volume_space, sinogram_space
+
+__all__ = ('rebin_sinogram', 'SinogramRebinning', 'SinogramRebinningAdjoint',
+           'preview_reconstruction')
+
+
+def _rebinned_shape(shape, factors):
+    """Return the shape after summing ``factors`` bins per axis."""
+    if len(factors) != len(shape):
+        raise ValueError('need one factor per axis of shape {}, got {}'
+                         ''.format(shape, factors))
+    for n, factor in zip(shape, factors):
+        if factor < 1 or n % factor:
+            raise ValueError('factors {} do not divide shape {}'
+                             ''.format(tuple(factors), tuple(shape)))
+    return tuple(n // factor for n, factor in zip(shape, factors))
+
+
+def rebin_sinogram(data, factors):
+    """Sum groups of ``factors`` adjacent bins along each axis.
+
+    Parameters
+    ----------
+    data : `array-like`
+        The sinogram.
+    factors : sequence of positive `int`
+        Number of bins summed per axis, each dividing the size of its axis.
+
+    Returns
+    -------
+    rebinned : `numpy.ndarray`
+    """
+    data = np.asarray(data)
+    shape = _rebinned_shape(data.shape, factors)
+    # Split every axis into (coarse bin, fine bin) and sum the fine ones
+    split = []
+    for n, factor in zip(shape, factors):
+        split += [n, factor]
+    return data.reshape(split).sum(axis=tuple(range(1, 2 * len(shape), 2)))
+
+
+class SinogramRebinning(odl.Operator):
+
+    """Sum of adjacent sinogram bins, e.g. mashing of angular views.
+
+    The range spans the same sinogram with fewer, larger bins.
+    """
+
+    def __init__(self, domain, factors):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        domain : `DiscreteLp`
+            The full sinogram space, e.g. from `sinogram_space`.
+        factors : sequence of positive `int`
+            Number of bins summed per axis, e.g. ``[1, 2, 1]`` to mash pairs
+            of views of a ``[radial, view, plane]`` sinogram.
+        """
+        self.factors = tuple(int(factor) for factor in factors)
+        shape = _rebinned_shape(domain.shape, self.factors)
+        range = odl.uniform_discr(domain.min_pt, domain.max_pt, shape,
+                                  dtype=domain.dtype)
+        odl.Operator.__init__(self, domain, range, linear=True)
+
+    def _call(self, x):
+        return rebin_sinogram(x, self.factors)
+
+    @property
+    def adjoint(self):
+        return SinogramRebinningAdjoint(self.range, self.domain, self.factors)
+
+
+class SinogramRebinningAdjoint(odl.Operator):
+
+    """Adjoint of `SinogramRebinning`, spreads each bin over its group."""
+
+    def __init__(self, domain, range, factors):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        domain : `DiscreteLp`
+            The rebinned sinogram space.
+        range : `DiscreteLp`
+            The full sinogram space.
+        factors : sequence of positive `int`
+            Number of bins summed per axis by the rebinning.
+        """
+        self.factors = tuple(int(factor) for factor in factors)
+        if _rebinned_shape(range.shape, self.factors) != domain.shape:
+            raise ValueError('`domain` shape {} does not match `range` shape '
+                             '{} rebinned by {}'.format(domain.shape,
+                                                        range.shape,
+                                                        self.factors))
+        odl.Operator.__init__(self, domain, range, linear=True)
+
+    def _call(self, y):
+        result = np.asarray(y)
+        for axis, factor in enumerate(self.factors):
+            if factor > 1:
+                result = np.repeat(result, factor, axis=axis)
+
+        # Account for the weighting of the inner products by the bin sizes
+        return result * (self.domain.cell_volume / self.range.cell_volume)
+
+    @property
+    def adjoint(self):
+        return SinogramRebinning(self.range, self.factors)
+
+
+def preview_reconstruction(data, fov, shape, settings, factors=None,
+                           volume_factor=2, niter=5):
+    """Reconstruct a coarse preview image from sinogram data.
+
+    The preview is faster than a full reconstruction by the smaller volume,
+    which reduces the work of every EMrecon projection.
+
+    Parameters
+    ----------
+    data : `array-like`
+        Full resolution sinogram.
+    fov : `array-like`
+        Size of the field of view in mm.
+    shape : `sequence` of `int`
+        Number of voxels per axis of the full resolution volume.
+    settings : `dict`
+        EMRecon settings, e.g. ``{'SCANNERTYPE': 3}``.
+    factors : sequence of positive `int`, optional
+        Rebinning factors of the sinogram axes, to fit the image to the
+        rebinned data. EMrecon projects the full sinogram either way, so
+        this does not make the preview faster. Default: no rebinning.
+    volume_factor : positive `int`, optional
+        Downsampling of the volume along each axis.
+    niter : positive `int`, optional
+        Number of MLEM iterations.
+
+    Returns
+    -------
+    preview : `DiscreteLpElement`
+        The coarse reconstruction.
+    """
+    data = np.asarray(data, dtype='float32')
+    coarse_shape = [max(1, int(n) // volume_factor) for n in shape]
+    space = volume_space(fov, coarse_shape)
+    op = EMReconForwardProjector(space, sinogram_space(data.shape),
+                                 settings=dict(settings))
+    if factors is not None:
+        rebinning = SinogramRebinning(op.range, factors)
+        op = rebinning * op
+        data = rebin_sinogram(data, rebinning.factors)
+
+    x = space.one()
+    monitored_mlem(op, x, data, niter)
+    return x
@@ -0,0 +1,133 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reconstruction of a region of interest (ROI).
+
+The activity of the whole field of view is first estimated at coarse
+resolution. The projection of its part outside the ROI is kept as a fixed
+additive background, with coarse voxels on the border of the ROI weighted
+by the fraction of their volume outside it, and MLEM then iterates on a
+fine sub-volume covering only the ROI. EMrecon gets the sub-volume
+through the ``OFFSET_*``, ``FOV_*`` and ``SIZE_*`` settings from
+`settings_from_domain`.
+"""
+
+import numpy as np
+
+from odlemrecon.convergence import monitored_mlem
+from odlemrecon.util import volume_space
+
+__all__ = ('roi_overlap', 'outside_roi_background', 'roi_reconstruction')
+
+
+def roi_overlap(space, roi):
+    """Return the fraction of the volume of each voxel inside ``roi``.
+
+    Parameters
+    ----------
+    space : `DiscreteLp`
+        Volume space.
+    roi : `DiscreteLp`
+        Space of the ROI, the box spanned by it is used.
+    """
+    overlap = np.ones(space.shape)
+    for axis in range(space.ndim):
+        lower = (space.min_pt[axis] +
+                 np.arange(space.shape[axis]) * space.cell_sides[axis])
+        upper = lower + space.cell_sides[axis]
+        inside = (np.minimum(upper, roi.max_pt[axis]) -
+                  np.maximum(lower, roi.min_pt[axis]))
+        inside = np.clip(inside / space.cell_sides[axis], 0, 1)
+        shape = [1] * space.ndim
+        shape[axis] = -1
+        overlap = overlap * inside.reshape(shape)
+    return overlap
+
+
+def outside_roi_background(estimate, roi, op):
+    """Return the projection of the activity outside the ROI.
+
+    Voxels partly inside the ROI contribute the part of their activity
+    outside it, see `roi_overlap`, so that activity at the border of the
+    ROI is neither counted twice nor lost.
+
+    Parameters
+    ----------
+    estimate : `DiscreteLpElement`
+        Activity estimate of the whole field of view.
+    roi : `DiscreteLp`
+        Space of the ROI.
+    op : `Operator`
+        Forward projector of ``estimate.space``.
+    """
+    outside = np.asarray(estimate, dtype='float32') * (
+        1 - roi_overlap(estimate.space, roi)).astype('float32')
+    return np.asarray(op(outside))
+
+
+def roi_reconstruction(projector, data, fov, coarse_shape, roi, niter=10,
+                       coarse_niter=5, sensitivities=None, callback=None,
+                       monitor=None):
+    """Reconstruct a fine ROI with the rest of the activity as background.
+
+    Parameters
+    ----------
+    projector : `callable`
+        Returns the forward projector of a volume space, e.g.
+        ``lambda space: EMReconForwardProjector(space, ran,
+        settings=dict(settings))``. Called for the coarse space and for
+        ``roi``.
+    data : `array-like`
+        Measured data, in the range of the projectors.
+    fov : `array-like`
+        Size of the whole field of view in mm.
+    coarse_shape : `sequence` of `int`
+        Number of voxels of the coarse estimate of the whole field of view.
+    roi : `DiscreteLp`
+        Fine volume space of the ROI, e.g.
+        ``odl.uniform_discr([-50, 20, -30], [50, 120, 30], [80, 80, 48],
+        dtype='float32')`` around a lesion.
+    niter : positive `int`, optional
+        Maximum number of MLEM iterations on the ROI.
+    coarse_niter : positive `int`, optional
+        Number of MLEM iterations of the coarse estimate.
+    sensitivities : `float`, optional
+        Sensitivities used in both stages. Default: back-projection of
+        ones, computed for each space.
+    callback : `callable`, optional
+        Called with the ROI iterate after each iteration.
+    monitor : `ConvergenceMonitor`, optional
+        Stops the ROI iteration at convergence.
+
+    Returns
+    -------
+    x : ``roi`` element
+        The ROI reconstruction.
+    """
+    coarse_space = volume_space(fov, coarse_shape, dtype=roi.dtype)
+    coarse_op = projector(coarse_space)
+    estimate = coarse_space.one()
+    monitored_mlem(coarse_op, estimate, data, coarse_niter,
+                   sensitivities=sensitivities)
+
+    background = outside_roi_background(estimate, roi, coarse_op)
+
+    roi_op = projector(roi)
+    x = roi.one()
+    monitored_mlem(roi_op, x, data, niter, sensitivities=sensitivities,
+                   callback=callback, monitor=monitor, background=background)
+    return x
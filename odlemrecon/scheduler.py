@@ -0,0 +1,235 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Process-wide scheduling of EMrecon runs.
+
+Every EMrecon process is started through the `default_scheduler`, which
+caps the number of concurrent processes and sets their ``OMP_NUM_THREADS``
+so that the runs in flight share a budget of cores: a run started alone
+gets all of them, one of several concurrent runs its share. Waiting runs are
+started in order of priority, then of arrival, so that e.g. interactive
+previews overtake batch studies::
+
+    with odlemrecon.job_priority(odlemrecon.PRIORITY_INTERACTIVE):
+        preview = odlemrecon.preview_reconstruction(...)
+
+The default scheduler is configured with ``$ODLEMRECON_CORES`` and
+``$ODLEMRECON_MAX_PROCESSES`` if these are set. Without either, an
+``$OMP_NUM_THREADS`` set by the user is left as it is. Worker pools share
+the cores of the node with `share_cores` as initializer.
+"""
+
+import contextlib
+import heapq
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+
+__all__ = ('Scheduler', 'default_scheduler', 'set_default_scheduler',
+           'job_priority', 'share_cores', 'PRIORITY_INTERACTIVE',
+           'PRIORITY_DEFAULT', 'PRIORITY_BATCH')
+
+
+# Smaller values run first
+PRIORITY_INTERACTIVE = -10
+PRIORITY_DEFAULT = 0
+PRIORITY_BATCH = 10
+
+_PRIORITY = threading.local()
+
+
+@contextlib.contextmanager
+def job_priority(priority):
+    """Run the EMrecon calls of this thread inside the block at ``priority``.
+
+    Parameters
+    ----------
+    priority : `int`
+        Smaller values run first, see `PRIORITY_INTERACTIVE`,
+        `PRIORITY_DEFAULT` and `PRIORITY_BATCH`.
+    """
+    previous = getattr(_PRIORITY, 'value', PRIORITY_DEFAULT)
+    _PRIORITY.value = priority
+    try:
+        yield
+    finally:
+        _PRIORITY.value = previous
+
+
+class Scheduler(object):
+
+    """Bounded, prioritized admission of EMrecon processes."""
+
+    def __init__(self, cores=None, max_processes=None):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        cores : positive `int`, optional
+            Total number of cores for all EMrecon processes. Default: the
+            number of CPUs.
+        max_processes : positive `int`, optional
+            Maximum number of concurrent EMrecon processes. Default:
+            ``cores``.
+
+        Notes
+        -----
+        If neither ``cores`` nor ``max_processes`` is given, no budget is
+        configured and a ``$OMP_NUM_THREADS`` of the environment is kept.
+        """
+        self.budget = cores is not None or max_processes is not None
+        self.cores = int(cores or multiprocessing.cpu_count())
+        self.max_processes = int(max_processes or self.cores)
+        if self.cores < 1 or self.max_processes < 1:
+            raise ValueError('`cores` and `max_processes` must be positive, '
+                             'got {} and {}'.format(cores, max_processes))
+
+        self._reset()
+
+    def _reset(self):
+        """Start with no runs, e.g. in a forked child process."""
+        self._pid = os.getpid()
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._counter = itertools.count()
+        self._running = 0
+        self._stats = {'started': 0, 'max_queued': 0, 'wait_time': 0.0,
+                       'max_wait_time': 0.0}
+
+    @property
+    def threads_per_process(self):
+        """Number of threads of each EMrecon process with all slots busy."""
+        return self.threads(self.max_processes)
+
+    def threads(self, nprocesses):
+        """Number of threads of each of ``nprocesses`` concurrent runs."""
+        return max(1, self.cores // min(nprocesses, self.max_processes))
+
+    @property
+    def stats(self):
+        """Current ``running`` and ``queued`` runs and totals so far.
+
+        The totals are the number of ``started`` runs, the ``max_queued``
+        queue depth and the total and maximum ``wait_time`` in seconds.
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            stats['running'] = self._running
+            stats['queued'] = len(self._waiting)
+        return stats
+
+    def environment(self, nprocesses=1):
+        """Return the environment of one of ``nprocesses`` EMrecon runs."""
+        env = dict(os.environ)
+        if self.budget or 'OMP_NUM_THREADS' not in env:
+            env['OMP_NUM_THREADS'] = str(self.threads(nprocesses))
+        return env
+
+    @contextlib.contextmanager
+    def slot(self, priority=None):
+        """Wait for a free process slot and hold it inside the block.
+
+        Parameters
+        ----------
+        priority : `int`, optional
+            Default: the priority set with `job_priority`.
+
+        Yields
+        ------
+        env : `dict`
+            Environment for the process. Its threads are the share of the
+            cores among the running and the waiting runs when the slot is
+            granted.
+        """
+        if os.getpid() != self._pid:
+            # Runs of the parent are not ours to wait for
+            self._reset()
+        if priority is None:
+            priority = getattr(_PRIORITY, 'value', PRIORITY_DEFAULT)
+        ticket = (priority, next(self._counter))
+        start = time.time()
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            self._stats['max_queued'] = max(self._stats['max_queued'],
+                                            len(self._waiting))
+            while (self._running >= self.max_processes or
+                   self._waiting[0] != ticket):
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._running += 1
+            env = self.environment(self._running + len(self._waiting))
+
+            wait_time = time.time() - start
+            self._stats['started'] += 1
+            self._stats['wait_time'] += wait_time
+            self._stats['max_wait_time'] = max(self._stats['max_wait_time'],
+                                               wait_time)
+            # The next waiting run may also fit
+            self._condition.notify_all()
+
+        try:
+            yield env
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify_all()
+
+
+_DEFAULT = [None]
+
+
+def default_scheduler():
+    """Return the scheduler of the EMrecon runs of this process."""
+    if _DEFAULT[0] is None:
+        cores = os.environ.get('ODLEMRECON_CORES')
+        max_processes = os.environ.get('ODLEMRECON_MAX_PROCESSES')
+        _DEFAULT[0] = Scheduler(
+            cores=int(cores) if cores else None,
+            max_processes=int(max_processes) if max_processes else None)
+    return _DEFAULT[0]
+
+
+def set_default_scheduler(scheduler):
+    """Set the scheduler of the EMrecon runs of this process.
+
+    Returns
+    -------
+    previous : `Scheduler`
+        The scheduler that was used before.
+    """
+    previous = _DEFAULT[0]
+    _DEFAULT[0] = scheduler
+    return previous
+
+
+def share_cores(nworkers):
+    """Give this process its share of the cores of ``nworkers`` processes.
+
+    Meant as initializer of worker pools, e.g.
+    ``multiprocessing.Pool(n, share_cores, (n,))``, so that the EMrecon
+    runs of all workers together stay within the core budget. Without a
+    configured budget, an ``$OMP_NUM_THREADS`` set by the user is kept, as
+    by the `default_scheduler`.
+    """
+    scheduler = default_scheduler()
+    cores = max(1, scheduler.cores // int(nworkers))
+    share = Scheduler(cores=cores,
+                      max_processes=min(scheduler.max_processes, cores))
+    share.budget = scheduler.budget
+    set_default_scheduler(share)
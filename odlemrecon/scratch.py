@@ -0,0 +1,315 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Managed scratch files for the exchange with EMrecon.
+
+All files are created in one private directory of a `ScratchSpace`, which
+is removed on `ScratchSpace.cleanup`, when leaving its ``with`` block, or at
+interpreter exit. Files of operators that are garbage collected are kept for
+reuse by later files of the same size.
+
+The default space, used by all operators, is placed in
+``$ODLEMRECON_SCRATCH_DIR`` (e.g. a tmpfs or NVMe mount) and limited to
+``$ODLEMRECON_SCRATCH_QUOTA`` bytes if these are set.
+"""
+
+import errno
+import os
+import shutil
+import tempfile
+import threading
+from multiprocessing.util import Finalize
+
+__all__ = ('ScratchSpace', 'ScratchFile', 'default_scratch',
+           'set_default_scratch')
+
+
+class ScratchFile(object):
+
+    """A file in a `ScratchSpace`.
+
+    Supports the part of the file interface used to hand data to EMrecon:
+    ``name``, `seek`, `write` and `flush`. The file is opened on first
+    write, EMrecon outputs are never opened.
+    """
+
+    def __init__(self, space, name, size):
+        """Initialize a new instance, use `ScratchSpace.file` instead."""
+        self.space = space
+        self.name = name
+        self.size = size
+        self._file = None
+        # Return the file to the space when this object is collected
+        self._finalizer = Finalize(self, space._release, args=(name,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def seek(self, offset):
+        if self._file is None:
+            self._file = open(self.name, 'r+b')
+        self._file.seek(offset)
+
+    def write(self, data):
+        if self._file is None:
+            self._file = open(self.name, 'r+b')
+        self._file.write(data)
+
+        end = self._file.tell()
+        if end > self.size:
+            self.space._account(self.name, end)
+            self.size = end
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def resize(self, size):
+        """Truncate or extend the file to ``size`` bytes."""
+        self.space._account(self.name, size)
+        self.size = size
+        if self._file is not None:
+            self._file.flush()
+        with open(self.name, 'r+b') as scratch_file:
+            scratch_file.truncate(size)
+
+    def release(self):
+        """Give the file back to its space."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._finalizer()
+
+
+class ScratchSpace(object):
+
+    """Directory of scratch files with reuse and quota accounting.
+
+    Used as context manager, the space becomes the default of all operators
+    created inside the ``with`` block, and is removed at its end::
+
+        with odlemrecon.ScratchSpace('/dev/shm', quota=2 ** 30):
+            op = odlemrecon.EMReconForwardProjector(space, ran, settings)
+            ...
+    """
+
+    def __init__(self, directory=None, quota=None, max_pooled=16):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        directory : `str`, optional
+            Where the private directory of the space is created. Default:
+            the system temp directory.
+        quota : positive `int`, optional
+            Maximum number of bytes held by the files of the space. Files
+            kept for reuse are deleted first when it is reached.
+        max_pooled : nonnegative `int`, optional
+            Maximum number of released files kept for reuse.
+        """
+        self.directory = directory
+        self.quota = quota
+        self.max_pooled = int(max_pooled)
+
+        self._lock = threading.RLock()
+        self._counter = 0
+        self._previous = []
+        self._reset()
+
+    def _reset(self):
+        """Start with no files, e.g. in a forked child process."""
+        self.path = None
+        self._pid = os.getpid()
+        self._sizes = {}
+        self._pool = {}
+        self._settings = {}
+        self._finalizer = None
+
+    def _check_pid(self):
+        """Never touch the files of the parent in a forked child."""
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def __enter__(self):
+        self._previous.append(set_default_scratch(self))
+        return self
+
+    def __exit__(self, *exc):
+        set_default_scratch(self._previous.pop())
+        self.cleanup()
+
+    @property
+    def used(self):
+        """Number of bytes held by the files of the space."""
+        with self._lock:
+            self._check_pid()
+            return sum(self._sizes.values())
+
+    def _ensure_path(self):
+        if self.path is None:
+            if self.directory is not None and not os.path.isdir(
+                    self.directory):
+                os.makedirs(self.directory)
+            self.path = tempfile.mkdtemp(prefix='odlemrecon-',
+                                         dir=self.directory)
+            # Also runs at exit of the main and of multiprocessing children
+            self._finalizer = Finalize(self, shutil.rmtree,
+                                       args=(self.path, True), exitpriority=0)
+        return self.path
+
+    def _delete(self, name):
+        """Remove a file, the lock must be held."""
+        self._sizes.pop(name, None)
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+    def _reserve(self, size):
+        """Make room for ``size`` bytes, the lock must be held."""
+        if self.quota is None:
+            return
+        for pooled in list(self._pool.values()):
+            while pooled and self.used + size > self.quota:
+                self._delete(pooled.pop())
+        if self.used + size > self.quota:
+            raise OSError(errno.ENOSPC,
+                          'scratch quota of {} bytes exceeded, {} in use, '
+                          '{} requested'.format(self.quota, self.used, size))
+
+    def _account(self, name, size):
+        """Record that the file ``name`` has grown to ``size`` bytes."""
+        with self._lock:
+            self._check_pid()
+            if name not in self._sizes:
+                return
+            self._reserve(size - self._sizes[name])
+            self._sizes[name] = size
+
+    def _release(self, name):
+        """Keep the file ``name`` for reuse or delete it."""
+        with self._lock:
+            self._check_pid()
+            if name not in self._sizes:
+                # Space already cleaned up
+                return
+            size = self._sizes[name]
+            npooled = sum(len(names) for names in self._pool.values())
+            if npooled < self.max_pooled:
+                self._pool.setdefault(size, []).append(name)
+            else:
+                self._delete(name)
+
+    def file(self, size=0, suffix=''):
+        """Return a scratch file of ``size`` bytes.
+
+        A released file of the same size is reused if available, otherwise
+        a new file is created and allocated.
+
+        Parameters
+        ----------
+        size : nonnegative `int`, optional
+            Expected size of the file, e.g. of an EMrecon output.
+        suffix : `str`, optional
+            Suffix of the file name of new files.
+
+        Returns
+        -------
+        scratch_file : `ScratchFile`
+        """
+        size = int(size)
+        with self._lock:
+            self._check_pid()
+            pooled = self._pool.get(size)
+            if pooled:
+                return ScratchFile(self, pooled.pop(), size)
+
+            self._reserve(size)
+            self._counter += 1
+            name = os.path.join(self._ensure_path(),
+                                'scratch{}{}'.format(self._counter, suffix))
+            with open(name, 'wb') as new_file:
+                if size and hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(new_file.fileno(), 0, size)
+                    except OSError:
+                        new_file.truncate(size)
+                else:
+                    new_file.truncate(size)
+            self._sizes[name] = size
+            return ScratchFile(self, name, size)
+
+    def settings_file(self, settings):
+        """Return the name of an EMRecon settings file for ``settings``.
+
+        Files are shared between equal settings and kept until cleanup.
+        """
+        content = '\n'.join('{}={}'.format(key, settings[key])
+                            for key in settings).encode('utf-8')
+        with self._lock:
+            self._check_pid()
+            if content not in self._settings:
+                settings_file = self.file(len(content), suffix='emrecon')
+                settings_file.seek(0)
+                settings_file.write(content)
+                settings_file.flush()
+                # Keep a reference so the file is never released
+                self._settings[content] = settings_file
+            return self._settings[content].name
+
+    def cleanup(self):
+        """Remove the directory of the space with all its files."""
+        with self._lock:
+            self._check_pid()
+            for settings_file in self._settings.values():
+                settings_file.release()
+            self._settings.clear()
+            self._pool.clear()
+            self._sizes.clear()
+            if self._finalizer is not None:
+                self._finalizer()
+                self._finalizer = None
+            self.path = None
+
+
+_DEFAULT = [None]
+
+
+def default_scratch():
+    """Return the scratch space used by the operators."""
+    if _DEFAULT[0] is None:
+        quota = os.environ.get('ODLEMRECON_SCRATCH_QUOTA')
+        _DEFAULT[0] = ScratchSpace(
+            directory=os.environ.get('ODLEMRECON_SCRATCH_DIR'),
+            quota=int(quota) if quota else None)
+    return _DEFAULT[0]
+
+
+def set_default_scratch(space):
+    """Set the scratch space used by the operators.
+
+    Returns
+    -------
+    previous : `ScratchSpace`
+        The space that was used before.
+    """
+    previous = _DEFAULT[0]
+    _DEFAULT[0] = space
+    return previous
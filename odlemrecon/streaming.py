@@ -0,0 +1,195 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Incremental reconstruction during a list-mode acquisition.
+
+Events are added in batches, e.g. read from a .l file while it is being
+written. Each batch is appended to one event store in scratch space and
+to the reference file of the list-mode projector, see
+`EMReconForwardProjectorList.extended`, and the current image is refined
+by a few EM updates over all events received so far, starting from the
+image of the previous batch. The number of EMrecon
+runs per update thus depends on the number of events and the
+``memory_budget``, not on the number of batches.
+"""
+
+import os
+import time
+
+import numpy as np
+
+from odlemrecon.em import osem
+from odlemrecon.emreconoperators import EMReconForwardProjectorList
+from odlemrecon.scratch import default_scratch
+from odlemrecon.util import listmode_space
+
+__all__ = ('StreamingReconstructor',)
+
+
+# Bytes per list-mode event in a .l file
+_RECORD_SIZE = 4 * 7
+
+
+class StreamingReconstructor(object):
+
+    """Warm-started MLEM over a growing set of list-mode events."""
+
+    def __init__(self, space, settings, file_name=None, niter=2,
+                 min_batch=100000, sensitivities=1.0, memory_budget=None):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        space : `DiscreteLp`
+            Volume space of the reconstruction.
+        settings : `dict`
+            EMRecon settings, e.g. ``{'SCANNERTYPE': 1}``.
+        file_name : `str`, optional
+            .l file that is appended to during the acquisition, read by
+            `poll` and `follow`.
+        niter : positive `int`, optional
+            Number of EM updates after each batch.
+        min_batch : positive `int`, optional
+            Events are buffered until at least this many have arrived, to
+            keep the number of EMrecon calls per update low.
+        sensitivities : `float` or `array-like`, optional
+            Sensitivities of the EM update. As for the list-mode examples,
+            the default ignores them.
+        memory_budget : positive `int`, optional
+            Passed to the projector of the events, which then projects
+            them chunk by chunk from the store.
+        """
+        self.space = space
+        self.settings = settings
+        self.file_name = file_name
+        self.niter = int(niter)
+        self.min_batch = int(min_batch)
+        self.sensitivities = sensitivities
+        self.memory_budget = memory_budget
+
+        self.x = space.one()
+        self.op = None
+        self.nevents = 0
+        self._store = default_scratch().file()
+        self._pending = []
+        self._offset = 0
+
+    def _update(self, niter):
+        """Run ``niter`` EM updates over all events."""
+        events = np.memmap(self._store.name, dtype='float32', mode='r',
+                           shape=(self.nevents, 7))
+        osem([self.op], self.x, [events[:, 6]], niter,
+             sensitivities=self.sensitivities)
+
+    def add_events(self, events, flush=False):
+        """Add a batch of events and refine the image.
+
+        Parameters
+        ----------
+        events : `array-like`, shape ``(n, 7)``
+            New events ``[px_1, py_1, pz_1, px_2, py_2, pz_2, val]``.
+        flush : bool, optional
+            If ``True``, also use fewer than ``min_batch`` buffered events.
+
+        Returns
+        -------
+        updated : bool
+            Whether the image was updated.
+        """
+        events = np.asarray(events, dtype='float32').reshape([-1, 7])
+        if len(events):
+            self._pending.append(events)
+        npending = sum(len(batch) for batch in self._pending)
+        if npending == 0 or (npending < self.min_batch and not flush):
+            return False
+
+        batch = np.concatenate(self._pending)
+        self._pending = []
+        self._store.seek(4 * 7 * self.nevents)
+        self._store.write(batch.data)
+        self._store.flush()
+        self.nevents += len(batch)
+
+        events = np.memmap(self._store.name, dtype='float32', mode='r',
+                           shape=(self.nevents, 7))
+        if self.op is None:
+            self.op = EMReconForwardProjectorList(
+                self.space, listmode_space(self.nevents), events[:, :6],
+                settings=dict(self.settings),
+                memory_budget=self.memory_budget)
+        else:
+            self.op = self.op.extended(events[:, :6])
+
+        self._update(self.niter)
+        return True
+
+    def poll(self, flush=False):
+        """Read the events appended to ``file_name`` since the last call.
+
+        Only complete records are read, a partially written event is left
+        for the next call.
+
+        Returns
+        -------
+        updated : bool
+            Whether the image was updated.
+        """
+        if self.file_name is None:
+            raise ValueError('no `file_name` given')
+        nbytes = os.path.getsize(self.file_name) - self._offset
+        count = nbytes // _RECORD_SIZE
+        events = np.empty((0, 7), dtype='float32')
+        if count:
+            with open(self.file_name, 'rb') as events_file:
+                events_file.seek(self._offset)
+                events = np.fromfile(events_file, dtype='float32',
+                                     count=7 * count).reshape([-1, 7])
+            self._offset += count * _RECORD_SIZE
+        return self.add_events(events, flush=flush)
+
+    def follow(self, interval=1.0, idle_timeout=60.0, callback=None):
+        """Poll ``file_name`` until no events arrive for ``idle_timeout``.
+
+        Parameters
+        ----------
+        interval : positive `float`, optional
+            Seconds between two polls.
+        idle_timeout : positive `float`, optional
+            The acquisition is taken as finished when the file has not grown
+            for this many seconds.
+        callback : `callable`, optional
+            Called with the image after each update.
+        """
+        last_growth = time.time()
+        while True:
+            offset = self._offset
+            if self.poll() and callback is not None:
+                callback(self.x)
+            if self._offset != offset:
+                last_growth = time.time()
+            elif time.time() - last_growth > idle_timeout:
+                break
+            time.sleep(interval)
+
+        if self.add_events([], flush=True) and callback is not None:
+            callback(self.x)
+
+    def finish(self, niter):
+        """Use the buffered events and run ``niter`` more EM updates."""
+        if not self.add_events([], flush=True) and self.op is None:
+            return
+        self._update(niter)
@@ -0,0 +1,466 @@
+# Copyright 2014-2016 The ODL development group
+#
+# This file is part of ODL.
+#
+# ODL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ODL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ODL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cached sparse system matrices for small fields of view."""
+
+
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import odl
+import scipy.sparse
+
+from odlemrecon.util import settings_from_domain
+
+__all__ = ('listmode_system_matrix', 'probe_system_matrix',
+           'system_matrix_key', 'save_system_matrix', 'load_system_matrix',
+           'cached_system_matrix', 'SparseForwardProjector',
+           'SparseBackProjector')
+
+
+def _default_cache_dir():
+    """Return the directory where system matrices are cached."""
+    return os.environ.get(
+        'ODLEMRECON_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'odlemrecon'))
+
+
+def listmode_system_matrix(domain, geometry, oversampling=2,
+                           chunk_size=4096):
+    """Ray-trace list-mode lines of response through a volume.
+
+    Each line is clipped to the volume box and sampled uniformly, every
+    sample contributing its share of the intersection length to the voxel
+    it falls in. The result approximates line integrals in the units of
+    ``domain``.
+
+    Parameters
+    ----------
+    domain : `DiscreteLp`
+        The volume space.
+    geometry : `array-like`, shape ``(n, 6)``
+        Lines of response given as ``[px_1, py_1, pz_1, px_2, py_2, pz_2]``.
+    oversampling : positive `int`, optional
+        Number of samples per smallest cell side.
+    chunk_size : positive `int`, optional
+        Number of lines traced at once, limits temporary memory.
+
+    Returns
+    -------
+    matrix : `scipy.sparse.csr_matrix`
+        Matrix of shape ``(n, domain.size)`` with voxels in Fortran order.
+    """
+    geometry = np.asarray(geometry, dtype='float64')
+    if geometry.ndim != 2 or geometry.shape[1] != 6:
+        raise ValueError('`geometry` must have shape (n, 6), got {}'
+                         ''.format(geometry.shape))
+
+    shape = np.array(domain.shape)
+    min_pt = np.asarray(domain.min_pt, dtype='float64')
+    max_pt = np.asarray(domain.max_pt, dtype='float64')
+    cell_sides = (max_pt - min_pt) / shape
+
+    step = cell_sides.min() / oversampling
+    nsamples = int(np.ceil(np.linalg.norm(max_pt - min_pt) / step))
+    # Sample at the midpoints of nsamples equal intervals of each segment
+    fractions = (np.arange(nsamples) + 0.5) / nsamples
+
+    rows, cols, vals = [], [], []
+    for start in range(0, geometry.shape[0], chunk_size):
+        chunk = geometry[start:start + chunk_size]
+        p1, p2 = chunk[:, :3], chunk[:, 3:]
+        direction = p2 - p1
+
+        # Clip the lines to the volume box (slab method)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_lo = (min_pt - p1) / direction
+            t_hi = (max_pt - p1) / direction
+        t_near = np.where(direction != 0, np.minimum(t_lo, t_hi), -np.inf)
+        t_far = np.where(direction != 0, np.maximum(t_lo, t_hi), np.inf)
+        inside = (direction != 0) | ((p1 >= min_pt) & (p1 < max_pt))
+        t0 = np.maximum(t_near.max(axis=1), 0.0)
+        t1 = np.minimum(t_far.min(axis=1), 1.0)
+        hit = inside.all(axis=1) & (t1 > t0)
+        if not np.any(hit):
+            continue
+
+        line_idx = np.nonzero(hit)[0]
+        t0, t1 = t0[hit], t1[hit]
+        p1, direction = p1[hit], direction[hit]
+        weight = (t1 - t0) * np.linalg.norm(direction, axis=1) / nsamples
+
+        t = t0[:, None] + (t1 - t0)[:, None] * fractions[None, :]
+        points = p1[:, None, :] + t[:, :, None] * direction[:, None, :]
+        idx = np.floor((points - min_pt) / cell_sides).astype('int64')
+        idx = np.clip(idx, 0, shape - 1)
+        flat = idx[..., 0] + shape[0] * (idx[..., 1] + shape[1] * idx[..., 2])
+
+        rows.append(np.repeat(start + line_idx, nsamples))
+        cols.append(flat.ravel())
+        vals.append(np.repeat(weight, nsamples))
+
+    if rows:
+        rows, cols, vals = (np.concatenate(rows), np.concatenate(cols),
+                            np.concatenate(vals))
+    else:
+        rows = cols = np.zeros(0, dtype='int64')
+        vals = np.zeros(0)
+
+    matrix = scipy.sparse.coo_matrix(
+        (vals.astype('float32'), (rows, cols)),
+        shape=(geometry.shape[0], domain.size))
+    return matrix.tocsr()
+
+
+def probe_system_matrix(op, threshold=0.0, callback=None):
+    """Assemble the matrix of a linear operator column by column.
+
+    Every column is obtained by applying ``op`` to a unit impulse, hence this
+    reproduces the model of e.g. `EMReconForwardProjector` exactly, at the
+    price of one projection per voxel. Only feasible for small volumes.
+
+    Parameters
+    ----------
+    op : `Operator`
+        Linear operator whose domain is a volume space.
+    threshold : nonnegative `float`, optional
+        Entries with absolute value not above this are dropped.
+    callback : `callable`, optional
+        Called with the voxel index after each column.
+
+    Returns
+    -------
+    matrix : `scipy.sparse.csr_matrix`
+        Matrix of shape ``(op.range.size, op.domain.size)``. Voxels and data
+        are both in Fortran order.
+    """
+    impulse = np.zeros(op.domain.size, dtype='float32')
+    indices, data, indptr = [], [], [0]
+    for j in range(op.domain.size):
+        impulse[j] = 1.0
+        column = op(impulse.reshape(op.domain.shape, order='F'))
+        impulse[j] = 0.0
+
+        column = np.asarray(column, dtype='float32').ravel(order='F')
+        nonzero = np.nonzero(np.abs(column) > threshold)[0]
+        indices.append(nonzero)
+        data.append(column[nonzero])
+        indptr.append(indptr[-1] + nonzero.size)
+
+        if callback is not None:
+            callback(j)
+
+    matrix = scipy.sparse.csc_matrix(
+        (np.concatenate(data), np.concatenate(indices), np.array(indptr)),
+        shape=(op.range.size, op.domain.size))
+    return matrix.tocsr()
+
+
+def system_matrix_key(domain, range, settings=None, geometry=None,
+                      method=None):
+    """Return a string identifying a projection geometry.
+
+    Parameters
+    ----------
+    domain : `DiscreteLp`
+        The volume space.
+    range : `TensorSpace`
+        The data space.
+    settings : `dict`, optional
+        EMRecon settings of the projector.
+    geometry : `array-like`, optional
+        List-mode lines of response.
+    method : `str`, optional
+        How the matrix was assembled.
+    """
+    settings = dict(settings or {})
+    settings.update(settings_from_domain(domain))
+    description = {
+        'settings': sorted((str(k), str(v)) for k, v in settings.items()),
+        'range_shape': list(range.shape),
+        'method': method}
+
+    digest = hashlib.sha1(json.dumps(description).encode('utf-8'))
+    if geometry is not None:
+        geometry = np.ascontiguousarray(geometry, dtype='float32')
+        digest.update(geometry.tobytes())
+    return digest.hexdigest()
+
+
+def save_system_matrix(matrix, path):
+    """Store a matrix as memory-mappable arrays in the directory ``path``.
+
+    Both the matrix and its transpose are stored in CSR format so that
+    forward and back projection can each be split over rows.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    # Write to a temporary directory first so readers never see partial data
+    tmpdir = tempfile.mkdtemp(dir=parent)
+    try:
+        matrix = scipy.sparse.csr_matrix(matrix, dtype='float32')
+        transposed = matrix.transpose().tocsr()
+        for prefix, mat in (('', matrix), ('t_', transposed)):
+            np.save(os.path.join(tmpdir, prefix + 'data.npy'), mat.data)
+            np.save(os.path.join(tmpdir, prefix + 'indices.npy'), mat.indices)
+            np.save(os.path.join(tmpdir, prefix + 'indptr.npy'), mat.indptr)
+        np.save(os.path.join(tmpdir, 'shape.npy'), np.array(matrix.shape))
+        os.rename(tmpdir, path)
+    except Exception:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+
+def load_system_matrix(path, mmap_mode='r'):
+    """Load a matrix stored with `save_system_matrix`.
+
+    Returns
+    -------
+    matrix, transposed : `scipy.sparse.csr_matrix`
+        The matrix and its transpose, backed by memory-mapped arrays.
+    """
+    shape = tuple(np.load(os.path.join(path, 'shape.npy')))
+
+    result = []
+    for prefix, mat_shape in (('', shape), ('t_', shape[::-1])):
+        arrays = [np.load(os.path.join(path, prefix + name + '.npy'),
+                          mmap_mode=mmap_mode)
+                  for name in ('data', 'indices', 'indptr')]
+        result.append(scipy.sparse.csr_matrix(tuple(arrays), shape=mat_shape,
+                                              copy=False))
+    return tuple(result)
+
+
+def cached_system_matrix(domain, range, settings=None, geometry=None,
+                         cache_dir=None, nthreads=None):
+    """Return a sparse projector pair, assembling it on first use.
+
+    List-mode geometries are ray-traced with `listmode_system_matrix`, other
+    geometries are probed through `EMReconForwardProjector` with
+    `probe_system_matrix`. The result is stored under ``cache_dir`` keyed by
+    `system_matrix_key` and memory-mapped on later calls.
+
+    Parameters
+    ----------
+    domain : `DiscreteLp`
+        The volume space.
+    range : `TensorSpace`
+        The data space.
+    settings : `dict`, optional
+        EMRecon settings, used when probing and for the cache key.
+    geometry : `array-like`, shape ``(n, 6)``, optional
+        List-mode lines of response.
+    cache_dir : `str`, optional
+        Cache location. Default: ``$ODLEMRECON_CACHE_DIR`` or
+        ``~/.cache/odlemrecon``.
+    nthreads : positive `int`, optional
+        Number of threads used for the matrix-vector products.
+
+    Returns
+    -------
+    op : `SparseForwardProjector`
+    """
+    from odlemrecon.emreconoperators import EMReconForwardProjector
+
+    if cache_dir is None:
+        cache_dir = _default_cache_dir()
+
+    method = 'raytrace' if geometry is not None else 'probe'
+    key = system_matrix_key(domain, range, settings, geometry, method)
+    path = os.path.join(cache_dir, key)
+
+    if not os.path.isdir(path):
+        if geometry is not None:
+            matrix = listmode_system_matrix(domain, geometry)
+        else:
+            op = EMReconForwardProjector(domain, range,
+                                         settings=dict(settings or {}))
+            matrix = probe_system_matrix(op)
+        try:
+            save_system_matrix(matrix, path)
+        except OSError:
+            # Someone else stored the same matrix concurrently
+            if not os.path.isdir(path):
+                raise
+
+    matrix, transposed = load_system_matrix(path)
+    return SparseForwardProjector(domain, range, matrix, transposed,
+                                  nthreads=nthreads)
+
+
+def _row_blocks(matrix, nblocks):
+    """Split a CSR matrix into row blocks sharing its data arrays."""
+    bounds = np.linspace(0, matrix.shape[0], nblocks + 1).astype('int64')
+    blocks = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        if stop <= start:
+            continue
+        lo, hi = matrix.indptr[start], matrix.indptr[stop]
+        indptr = np.asarray(matrix.indptr[start:stop + 1]) - lo
+        block = scipy.sparse.csr_matrix(
+            (matrix.data[lo:hi], matrix.indices[lo:hi], indptr),
+            shape=(stop - start, matrix.shape[1]), copy=False)
+        blocks.append((start, stop, block))
+    return blocks
+
+
+_POOLS = {}
+
+
+class _ParallelMatVec(object):
+
+    """Multithreaded CSR matrix-vector product."""
+
+    def __init__(self, matrix, nthreads=None):
+        if nthreads is None:
+            nthreads = multiprocessing.cpu_count()
+        self.shape = matrix.shape
+        self.blocks = _row_blocks(matrix, nthreads)
+        if len(self.blocks) > 1:
+            if nthreads not in _POOLS:
+                _POOLS[nthreads] = ThreadPool(nthreads)
+            self.pool = _POOLS[nthreads]
+        else:
+            self.pool = None
+
+    def __call__(self, vec):
+        out = np.empty(self.shape[0], dtype='float32')
+
+        def product(block):
+            start, stop, mat = block
+            out[start:stop] = mat.dot(vec)
+
+        if self.pool is None:
+            for block in self.blocks:
+                product(block)
+        else:
+            # scipy releases the GIL in its sparse kernels
+            self.pool.map(product, self.blocks)
+        return out
+
+
+class SparseForwardProjector(odl.Operator):
+
+    """Forward projection as an in-process sparse matrix product."""
+
+    def __init__(self, domain, range, matrix, transposed=None, nthreads=None):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        domain : `DiscreteLp`
+            The volume space.
+        range : `TensorSpace`
+            The data space.
+        matrix : `scipy.sparse.spmatrix`
+            Matrix of shape ``(range.size, domain.size)``, voxels and data in
+            Fortran order.
+        transposed : `scipy.sparse.csr_matrix`, optional
+            Transpose of ``matrix`` in CSR format, computed if not given.
+        nthreads : positive `int`, optional
+            Number of threads used for the matrix-vector products.
+        """
+        if matrix.shape != (range.size, domain.size):
+            raise ValueError('`matrix` has shape {}, expected {}'
+                             ''.format(matrix.shape,
+                                       (range.size, domain.size)))
+
+        self.matrix = scipy.sparse.csr_matrix(matrix, copy=False)
+        if transposed is None:
+            transposed = self.matrix.transpose().tocsr()
+        self.transposed = transposed
+        self.nthreads = nthreads
+        self._matvec = _ParallelMatVec(self.matrix, nthreads)
+        self._adjoint = None
+        odl.Operator.__init__(self, domain, range, linear=True)
+
+    def _call(self, volume):
+        vec = np.asarray(volume, dtype='float32').ravel(order='F')
+        return self._matvec(vec).reshape(self.range.shape, order='F')
+
+    @property
+    def adjoint(self):
+        # Cached, since splitting the matrix into row blocks is not free
+        if self._adjoint is None:
+            self._adjoint = SparseBackProjector(
+                self.range, self.domain, self.transposed, self.matrix,
+                nthreads=self.nthreads)
+            self._adjoint._adjoint = self
+        return self._adjoint
+
+
+class SparseBackProjector(odl.Operator):
+
+    """Back projection as an in-process sparse matrix product."""
+
+    def __init__(self, domain, range, matrix, transposed=None, nthreads=None):
+        """Initialize a new instance.
+
+        Parameters
+        ----------
+        domain : `TensorSpace`
+            The data space.
+        range : `DiscreteLp`
+            The volume space.
+        matrix : `scipy.sparse.spmatrix`
+            Transpose of the forward matrix, shape
+            ``(range.size, domain.size)``.
+        transposed : `scipy.sparse.csr_matrix`, optional
+            The forward matrix in CSR format, computed if not given.
+        nthreads : positive `int`, optional
+            Number of threads used for the matrix-vector products.
+        """
+        if matrix.shape != (range.size, domain.size):
+            raise ValueError('`matrix` has shape {}, expected {}'
+                             ''.format(matrix.shape,
+                                       (range.size, domain.size)))
+
+        self.matrix = scipy.sparse.csr_matrix(matrix, copy=False)
+        if transposed is None:
+            transposed = self.matrix.transpose().tocsr()
+        self.transposed = transposed
+        self.nthreads = nthreads
+        self._matvec = _ParallelMatVec(self.matrix, nthreads)
+        self._adjoint = None
+        odl.Operator.__init__(self, domain, range, linear=True)
+
+    def _call(self, sinogram):
+        vec = np.asarray(sinogram, dtype='float32').ravel(order='F')
+        backproj = self._matvec(vec).reshape(self.range.shape, order='F')
+
+        # Scale the adjoint properly
+        backproj /= self.range.cell_volume
+
+        return backproj
+
+    @property
+    def adjoint(self):
+        # Cached, since splitting the matrix into row blocks is not free
+        if self._adjoint is None:
+            self._adjoint = SparseForwardProjector(
+                self.range, self.domain, self.transposed, self.matrix,
+                nthreads=self.nthreads)
+            self._adjoint._adjoint = self
+        return self._adjoint
@@ -18,45 +18,97 @@
 """Utilities for ease of use."""
 
 
-import tempfile
+import numpy as np
+import odl
 
+from odlemrecon.scratch import default_scratch
 
-__all__ = ('settings_from_domain', 'make_settings_file',)
+
+__all__ = ('settings_from_domain', 'make_settings_file',
+           'volume_space', 'sinogram_space', 'listmode_space')
 
 
 def settings_from_domain(domain):
     """Create settings from the parameters of a domain.
 
+    Works for any ``domain.dtype``, the values are plain Python numbers.
+
     Parameters
     ----------
     domain : `DiscreteLp`
         The volume space.
     """
-    return {'SIZE_X': domain.shape[0],
-            'SIZE_Y': domain.shape[1],
-            'SIZE_Z': domain.shape[2],
-            'OFFSET_X': domain.min_pt[0],
-            'OFFSET_Y': domain.min_pt[1],
-            'OFFSET_Z': domain.min_pt[2],
-            'FOV_X': domain.domain.extent()[0],
-            'FOV_Y': domain.domain.extent()[1],
-            'FOV_Z': domain.domain.extent()[2]}
+    extent = np.asarray(domain.max_pt) - np.asarray(domain.min_pt)
+    return {'SIZE_X': int(domain.shape[0]),
+            'SIZE_Y': int(domain.shape[1]),
+            'SIZE_Z': int(domain.shape[2]),
+            'OFFSET_X': float(domain.min_pt[0]),
+            'OFFSET_Y': float(domain.min_pt[1]),
+            'OFFSET_Z': float(domain.min_pt[2]),
+            'FOV_X': float(extent[0]),
+            'FOV_Y': float(extent[1]),
+            'FOV_Z': float(extent[2])}
+
+
+def volume_space(fov, shape, dtype='float32'):
+    """Create a volume space centered at the origin.
+
+    EMrecon computes in float32, so with the default ``dtype`` volumes are
+    passed to and from the EMRecon operators without conversion.
+
+    Parameters
+    ----------
+    fov : `array-like`
+        Size of the field of view in mm.
+    shape : `sequence` of `int`
+        Number of voxels per axis.
+    dtype : optional
+        Data type of the space.
+    """
+    fov = np.asarray(fov, dtype=float)
+    return odl.uniform_discr(-fov / 2, fov / 2, shape, dtype=dtype)
+
+
+def sinogram_space(shape, dtype='float32'):
+    """Create a sinogram space with unit bins.
+
+    Parameters
+    ----------
+    shape : `sequence` of `int`
+        Sinogram shape, given by the scanner, e.g. ``[192, 192, 175]``.
+    dtype : optional
+        Data type of the space.
+    """
+    return odl.uniform_discr([0] * len(shape), shape, shape, dtype=dtype)
+
+
+def listmode_space(nevents, dtype='float32'):
+    """Create the data space of ``nevents`` list-mode events.
+
+    Parameters
+    ----------
+    nevents : `int`
+        Number of events.
+    dtype : optional
+        Data type of the space.
+    """
+    return odl.rn(nevents, dtype=dtype)
 
 
 def make_settings_file(settings):
     """Create a temporary EMRecon settings file.
 
+    The file is created in the `default_scratch` space and shared between
+    calls with equal settings.
+
     Parameters
     ----------
     settings : `dict`
         Dictionary with the settings that should be written to the file.
         Consult EMRecon doc for information on what options are valid.
-    """
-    settings_str = '\n'.join('{}={}'.format(key, settings[key])
-                             for key in settings)
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix='emrecon') as settings_file:
-        settings_file.write(settings_str)
-        settings_file_name = settings_file.name
 
-    return settings_file_name
+    Returns
+    -------
+    settings_file_name : `str`
+    """
+    return default_scratch().settings_file(settings)
@@ -70,5 +70,9 @@ setup(
     package_dir={'odlemrecon': 'odlemrecon'},
 
     install_requires=['odl>=0.4',
-                      'numpy']
+                      'numpy',
+                      'scipy'],
+
+    entry_points={
+        'console_scripts': ['odlemrecon = odlemrecon.cli:main']},
 )